@@ -0,0 +1,271 @@
+import os
+import os.path as osp
+import json
+import itertools
+import threading
+import multiprocessing
+from django.db import close_old_connections
+from django.utils import timezone
+
+MAX_JOBS = 2
+MAX_MODEL_JOBS = 1
+POLL_SEC = 1.0
+START_SEC = 60.0
+JOB_SITUATION = {"train": "training", "test": "testing"}
+SWEEP_PARAMS = ["data_size", "train_ratio", "sm_scale", "lr", "batch_size"]
+
+
+def get_slots(num_slots):
+    """
+    Split CPU cores of this process into groups, one group for each running job
+
+    :param num_slots: Number of jobs run at the same time
+    :return: List of core sets, empty sets if cores can not be given
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return [set() for _ in range(num_slots)]
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < num_slots:
+        return [set(cores) for _ in range(num_slots)]
+    size = len(cores) // num_slots
+    return [set(cores[i * size:(i + 1) * size]) for i in range(num_slots)]
+
+
+def get_sweep_params(params, grid):
+    """
+    Expand a grid of params into the params of every run
+
+    :param params: Params shared by all runs, like: device, epochs, chunk_name
+    :param grid: Dict of param name and its values, names in SWEEP_PARAMS
+    :return: List of dict, one for each combination of values
+    """
+    names = [name for name in SWEEP_PARAMS if name in grid]
+    runs = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        run = dict(params)
+        run.update(zip(names, values))
+        runs.append(run)
+    return runs
+
+
+def prewarm(runs):
+    """
+    Check the chunks used by runs, and build their on-disk metadata once before the workers start
+    No DataFrame or waveforms are loaded in this process. Each run gets param 'store_size', the largest
+    data_size of its chunk, the first worker grows the sample store of the chunk to it (see Net.load),
+    and the other workers wait for it and read from the same store
+
+    :raise FileNotFoundError: if a chunk does not exist
+    """
+    import func.process as pro
+    for chunk_name in sorted({str(run["chunk_name"]) for run in runs}):
+        root = osp.join(pro.ROOT, chunk_name)
+        if not osp.exists(osp.join(root, chunk_name + ".csv")):
+            raise FileNotFoundError("Chunk {} not found".format(chunk_name))
+        pro.get_meta(root, chunk_name)
+    store_size = {}
+    for run in runs:
+        chunk_name = str(run["chunk_name"])
+        store_size[chunk_name] = max(store_size.get(chunk_name, 0), int(run["data_size"]))
+    for run in runs:
+        run["store_size"] = store_size[str(run["chunk_name"])]
+    return None
+
+
+def run_job(job_id, cores=None):
+    """
+    Run a train/test job in its own worker process, the result is saved in DlJob
+
+    :param job_id: Primary key of DlJob
+    :param cores: CPU cores the worker is pinned to, all cores if not given
+    """
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "web.settings")
+    if cores:
+        os.sched_setaffinity(0, cores)
+    import torch
+    if cores:
+        torch.set_num_threads(len(cores))
+    import django
+    django.setup()
+    from .models import DlModel, DlJob
+    import estimate.network as network
+
+    job = DlJob.objects.get(pk=job_id)
+    DlModel.objects.filter(name=job.name).update(situation=JOB_SITUATION[job.opt])
+    try:
+        model_object = getattr(network, job.name)()
+        params = json.loads(job.params)
+        if job.opt == "train":
+            result = model_object.training(params, job.name)
+        else:
+            result = model_object.testing(params, job.name)
+        job.situation = "done"
+    except FileNotFoundError:
+        result = {"error": "File not found"}
+        job.situation = "failed"
+    except Exception as e:
+        result = {"error": repr(e)}
+        job.situation = "failed"
+    job.result = json.dumps(result, default=str)
+    job.finished_at = timezone.now()
+    # process is updated by the training loop, not saved from this stale copy
+    job.save(update_fields=["situation", "result", "finished_at"])
+    free_model(job.name)
+    return None
+
+
+def is_job_alive(job):
+    """
+    Whether the worker process of a running job is still alive on this host
+    A job just claimed by another process of web server has no pid yet, it is alive for START_SEC
+    """
+    if job.pid is None:
+        return job.started_at is not None and (timezone.now() - job.started_at).total_seconds() < START_SEC
+    try:
+        os.kill(job.pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def is_tagged(job):
+    """
+    Whether a job saves its results in a directory of its own (param 'tag', like the runs of a sweep)
+    """
+    return bool(json.loads(job.params).get("tag"))
+
+
+def free_model(name):
+    """
+    Set DlModel.situation to be "Free", if no job of this model is still running
+    """
+    from .models import DlModel, DlJob
+    if not DlJob.objects.filter(name=name, situation="running").exists():
+        DlModel.objects.filter(name=name).update(situation="Free")
+    return None
+
+
+class JobQueue:
+    """
+    Persistent queue of train/test jobs (table DlJob), run by worker processes
+
+    At most max_jobs jobs run at the same time on this host, and max_model[name] jobs of each model which
+    share the output files of the model. Tagged jobs (runs of a sweep) have their own output files, and are
+    only limited by max_jobs.
+    Each worker owns a Net object of its own, and is pinned to its own group of CPU cores
+    """
+
+    def __init__(self, max_jobs=MAX_JOBS, poll_sec=POLL_SEC):
+        self.max_jobs = max_jobs
+        self.poll_sec = poll_sec
+        self.max_model = {}
+        self.procs = {}
+        self.slots = get_slots(max_jobs)
+        self.used = {}
+        self.lock = threading.Lock()
+        self.context = multiprocessing.get_context("spawn")
+        self.thread = None
+
+    def start(self):
+        """
+        Start the thread dispatching queued jobs, when starting service
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.loop, daemon=True)
+            self.thread.start()
+        return None
+
+    def loop(self):
+        event = threading.Event()
+        while not event.wait(self.poll_sec):
+            close_old_connections()
+            self.dispatch()
+
+    def submit(self, name, opt, params, sweep=""):
+        """
+        Add a job to the queue
+
+        :param name: Model name, like: MagInfoNet, EQGraphNet, MagNet
+        :param opt: 'train' or 'test'
+        :param params: Input JSON of ModelTrainView or ModelTestView
+        :param sweep: Id of the sweep which the job belongs to
+        :return: DlJob
+        """
+        from .models import DlJob
+        job = DlJob.objects.create(name=name, opt=opt, params=json.dumps(dict(params.items()), default=str),
+                                   sweep=sweep)
+        self.dispatch()
+        return job
+
+    def submit_sweep(self, names, params, grid):
+        """
+        Add a training job for every model and every combination of grid values
+
+        :param names: Model names
+        :param params: Params shared by all runs
+        :param grid: Dict of param name and its values
+        :return: Sweep id, list of DlJob
+        """
+        sweep = timezone.now().strftime("sweep_%Y%m%d%H%M%S%f")
+        runs = get_sweep_params(params, grid)
+        prewarm(runs)
+        jobs = []
+        for name in names:
+            for i, run in enumerate(runs):
+                run["tag"] = "{}_{}".format(sweep, i)
+                jobs.append(self.submit(name, "train", run, sweep))
+        return sweep, jobs
+
+    def reap(self):
+        """
+        Remove finished worker processes, jobs of dead workers are failed
+        """
+        from .models import DlJob
+        for job_id, proc in list(self.procs.items()):
+            if proc.is_alive():
+                continue
+            proc.join()
+            del self.procs[job_id]
+            del self.used[job_id]
+            died = DlJob.objects.filter(pk=job_id, situation="running")
+            if died.exists():
+                name = died[0].name
+                died.update(situation="failed", finished_at=timezone.now(),
+                            result=json.dumps({"error": "Worker exited with code {}".format(proc.exitcode)}))
+                free_model(name)
+        return None
+
+    def dispatch(self):
+        """
+        Start queued jobs in order, until the limit is reached
+        """
+        from .models import DlJob
+        with self.lock:
+            self.reap()
+            running = list(DlJob.objects.filter(situation="running"))
+            names = [job.name for job in running if not is_tagged(job)]
+            num_model = {name: names.count(name) for name in set(names)}
+            num_running = len(running)
+            for job in DlJob.objects.filter(situation="queued").order_by('pk'):
+                if num_running >= self.max_jobs:
+                    break
+                tagged = is_tagged(job)
+                if not tagged and num_model.get(job.name, 0) >= self.max_model.get(job.name, MAX_MODEL_JOBS):
+                    continue
+                # claim the job, other processes of web server may also dispatch
+                if not DlJob.objects.filter(pk=job.pk, situation="queued").update(
+                        situation="running", started_at=timezone.now()):
+                    continue
+                # jobs started by other processes of web server are not counted here, their cores may be shared
+                slot = min(set(range(len(self.slots))) - set(self.used.values()), default=0)
+                proc = self.context.Process(target=run_job, args=(job.pk, self.slots[slot]), daemon=False)
+                proc.start()
+                DlJob.objects.filter(pk=job.pk).update(pid=proc.pid)
+                self.procs[job.pk] = proc
+                self.used[job.pk] = slot
+                if not tagged:
+                    num_model[job.name] = num_model.get(job.name, 0) + 1
+                num_running = num_running + 1
+        return None
@@ -39,6 +39,23 @@ class DlModelStatus(models.Model):
         return {field.name: getattr(self, field.name) for field in self._meta.fields}
 
 
+class DlJob(models.Model):
+    name = models.CharField(max_length=128)
+    opt = models.CharField(max_length=16)
+    params = models.CharField(max_length=5000)
+    situation = models.CharField(max_length=128, default="queued")
+    process = models.CharField(max_length=50000, blank=True)
+    result = models.CharField(max_length=50000, blank=True)
+    pid = models.IntegerField(null=True, blank=True)
+    sweep = models.CharField(max_length=128, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def to_dict(self):
+        return {field.name: getattr(self, field.name) for field in self._meta.fields}
+
+
 class Feature(models.Model):
     param = models.CharField(max_length=128)
     description = models.CharField(max_length=1000)
@@ -1,11 +1,13 @@
 import pandas as pd
 import torch
+import os
 import os.path as osp
+import time
+import resource
 import numpy as np
 from tqdm import tqdm
-from torch.utils.data import DataLoader
 from torch.nn import Parameter
-from .models import DlModel, DlModelStatus
+from .models import DlModel, DlModelStatus, DlJob
 from abc import ABC, abstractmethod
 from django.db import transaction
 import sys
@@ -13,6 +15,63 @@ sys.path.append("..")
 import func.net as net
 import func.process as pro
 
+TEST_MEM_MB = 1024
+MAX_TEST_BATCH = 4096
+TEST_PROBES = (4, 16)
+PS_AT_NAME = ["p_arrival_sample", "s_arrival_sample"]
+P_T_NAME = ["p_travel_sec"]
+
+
+class PredAccumulator:
+    """
+    Collect true magnitudes and predicted results of one epoch
+
+    Arrays are allocated once on device and filled by slice, running sums give RMSE and R2
+    without another pass over the arrays
+    """
+
+    def __init__(self, num, device):
+        self.true = torch.zeros(num, device=device)
+        self.pred = torch.zeros(num, device=device)
+        self.sums = torch.zeros(6, dtype=torch.float64, device=device)
+        self.num = 0
+
+    def reset(self):
+        self.sums.zero_()
+        self.num = 0
+        return self
+
+    def add(self, true_one, pred_one):
+        true_one, pred_one = true_one.detach().reshape(-1), pred_one.detach().reshape(-1)
+        size = true_one.shape[0]
+        self.true[self.num:self.num + size] = true_one
+        self.pred[self.num:self.num + size] = pred_one
+        t, p = true_one.double(), pred_one.double()
+        # sum of: t, p, t*t, p*p, t*p, (t-p)^2
+        self.sums += torch.stack([t.sum(), p.sum(), (t * t).sum(), (p * p).sum(), (t * p).sum(),
+                                  ((t - p) ** 2).sum()])
+        self.num = self.num + size
+        return None
+
+    def cal_rmse(self):
+        sums = self.sums.cpu().numpy()
+        return np.sqrt(sums[5] / self.num)
+
+    def cal_r2(self):
+        """
+        Square of Pearson correlation, the same as net.cal_r2_one_arr
+        """
+        s_t, s_p, s_tt, s_pp, s_tp, _ = self.sums.cpu().numpy()
+        cov = s_tp - s_t * s_p / self.num
+        var_t, var_p = s_tt - s_t * s_t / self.num, s_pp - s_p * s_p / self.num
+        return cov ** 2 / (var_t * var_p)
+
+    def numpy(self):
+        """
+        :return: true, pred (numpy arrays)
+        """
+        return self.true[:self.num].cpu().numpy(), self.pred[:self.num].cpu().numpy()
+
 
 class Net(ABC):
     def __init__(self):
@@ -29,6 +88,15 @@ class Net(ABC):
         self.data_size_train = 750
         self.data_size_test = 250
         self.model_name = "EQGraphNet"
+        self.tag = ""
+        self.accum_steps = 1
+        self.amp = False
+        self.compile = False
+        self.non_blocking = False
+        self.mem_budget = TEST_MEM_MB
+        self.prefetch = pro.get_prefetch()
+        self.store_size = 0
+        self.norm = None
         self.idx_train = None
         self.idx_test = None
         self.model = self.init_model()
@@ -57,6 +125,7 @@ class Net(ABC):
         self.data_size = int(input_data["data_size"].values[0])
         self.data_size_train = int(self.data_size * train_ratio)
         self.data_size_test = self.data_size - self.data_size_train
+        self.read_loop_params(input_data)
 
         self.model_name = model_name
         # self.root = osp.join(input_data["root"].values[0], self.chunk_name)
@@ -65,9 +134,10 @@ class Net(ABC):
             self.root = osp.join(self.root, self.chunk_name)
         if self.re_ad.split('/')[-1] != self.model_name:
             self.re_ad = osp.join(self.re_ad, self.model_name)
+        # runs of a sweep save their results in own directory
+        self.tag = str(input_data["tag"].values[0]) if "tag" in input_data.columns else ""
 
-        np.random.seed(100)
-        self.idx_train, _ = pro.get_train_or_test_idx(self.data_size, self.data_size_train)
+        self.idx_train, _ = pro.load_split(self.root, self.data_size, self.data_size_train)
         return None
 
     def read_test_params(self, input_data, model_name):
@@ -84,6 +154,7 @@ class Net(ABC):
         self.data_size = int(input_data["data_size"].values[0])
         self.data_size_train = int(self.data_size * train_ratio)
         self.data_size_test = self.data_size - self.data_size_train
+        self.read_loop_params(input_data)
 
         self.model_name = model_name
         # self.root = osp.join(input_data["root"].values[0], self.chunk_name)
@@ -92,31 +163,153 @@ class Net(ABC):
             self.root = osp.join(self.root, self.chunk_name)
         if self.re_ad.split('/')[-1] != self.model_name:
             self.re_ad = osp.join(self.re_ad, self.model_name)
+        # runs of a sweep save their results in own directory
+        self.tag = str(input_data["tag"].values[0]) if "tag" in input_data.columns else ""
 
-        np.random.seed(100)
-        _, self.idx_test = pro.get_train_or_test_idx(self.data_size, self.data_size_train)
+        self.idx_train, self.idx_test = pro.load_split(self.root, self.data_size, self.data_size_train)
         self.model.load_state_dict(
-            torch.load(osp.join(self.re_ad, str(self.data_size), "model_{}_{}_{}_{}.pkl".
-                                format(self.sm_scale, self.chunk_name, self.data_size_train, self.data_size_test))))
+            pro.load_checkpoint(osp.join(self.get_result_ad(), "model_{}_{}_{}_{}.pkl".
+                                         format(self.sm_scale, self.chunk_name, self.data_size_train,
+                                                self.data_size_test))))
         self.model.to(self.device)
         return None
 
+    def read_loop_params(self, input_data):
+        """
+        read optional params of training and testing loop, the defaults keep the plain loop
+
+        accum_steps: number of batches whose gradients are accumulated before one optimizer step
+        amp: bool, run forward in mixed precision (float16 on gpu, bfloat16 on cpu)
+        compile: bool, run model by torch.compile
+        non_blocking: bool, copy batches to device asynchronously, default True on gpu
+        mem_budget: peak memory (MB) of one testing batch, which decides the testing batch size
+        batch_size: also read for testing, a testing batch below it is reported
+        prefetch: number of batches prepared ahead by loader thread, 0 for no prefetching,
+                  default pro.PREFETCH with more than one core and 0 with one core
+        store_size: size which the sample store is grown to, if larger than data_size (set by sweeps)
+        """
+        def read_opt(name, default):
+            if name not in input_data.columns:
+                return default
+            value = input_data[name].values[0]
+            if isinstance(default, bool):
+                return str(value).lower() in ["true", "1"]
+            return type(default)(value)
+
+        self.accum_steps = max(read_opt("accum_steps", 1), 1)
+        self.amp = read_opt("amp", False)
+        self.compile = read_opt("compile", False)
+        self.non_blocking = read_opt("non_blocking", str(self.device).startswith("cuda"))
+        self.mem_budget = read_opt("mem_budget", float(TEST_MEM_MB))
+        self.batch_size = read_opt("batch_size", self.batch_size)
+        self.prefetch = read_opt("prefetch", pro.get_prefetch())
+        self.store_size = read_opt("store_size", 0)
+        return None
+
+    def get_result_ad(self):
+        """
+        Directory of saved results and model, re_ad/model_name/data_size(/tag)
+        """
+        if self.tag:
+            return osp.join(self.re_ad, str(self.data_size), self.tag)
+        return osp.join(self.re_ad, str(self.data_size))
+
     def load(self, train):
         """
         load Training or Testing set
 
         :param train: bool, True for Training set, False for Testing set
-        :return: data, sm, df, sm_scale, and idx_sm
+        :return: data, rows, sm, df, sm_scale, and idx_sm
         """
-        if train:
-            data, sm, df, sm_scale, idx_sm = load_data(self.root, self.chunk_name, self.data_size,
-                                                       self.idx_train, self.device, self.sm_scale)
-        else:
-            data, sm, df, sm_scale, idx_sm = load_data(self.root, self.chunk_name, self.data_size,
-                                                       self.idx_test, self.device, self.sm_scale)
-        return data, sm, df, sm_scale, idx_sm
+        if not pro.is_legacy_sample(self.root, self.data_size):
+            # the sample is a prefix of the sample store, only the missing traces are extracted
+            pro.grow_store(self.root, self.chunk_name, max(self.data_size, self.store_size))
+        idx = self.idx_train if train else self.idx_test
+        return load_data(self.root, self.chunk_name, self.data_size, idx, self.sm_scale)
 
     @abstractmethod
+    def get_dataset(self, data, sm, df, rows):
+        """
+        Dataset of model, from waveforms, magnitudes and rows of chunk.csv
+        rows[i] is the row of data for the i-th magnitude, the set is not copied out of data
+        """
+        return None
+
+    def get_loader(self, dataset, batch_size=None, shuffle=True):
+        batch_size = self.batch_size if batch_size is None else batch_size
+        on_device = torch.is_tensor(dataset.data) and dataset.data.is_cuda
+        pin_memory = str(self.device).startswith("cuda") and not on_device
+        return pro.BatchLoader(dataset, batch_size, shuffle=shuffle, prefetch=self.prefetch, pin_memory=pin_memory)
+
+    def get_probe_mem(self, dataset, num):
+        """
+        Peak memory (bytes) of one testing forward pass of num samples, inputs included
+
+        Measured by the allocator on gpu, and by the peak RSS (reset through /proc/self/clear_refs) on cpu.
+        0 if it can not be measured
+        """
+        batch = dataset.get_batch(np.arange(num))
+        on_cuda = str(self.device).startswith("cuda")
+        if on_cuda:
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            base = torch.cuda.memory_allocated(self.device)
+        elif reset_peak_rss():
+            base = read_rss()[0]
+        else:
+            return 0
+        inputs, _, _ = self.get_batch(batch)
+        with torch.inference_mode():
+            self.model(*inputs)
+        if on_cuda:
+            torch.cuda.synchronize(self.device)
+            return torch.cuda.max_memory_allocated(self.device) - base
+        return read_rss()[1] - base
+
+    def get_leaf_mem(self, dataset, num):
+        """
+        Size (bytes) of inputs and outputs of all leaf layers in one forward pass of num samples,
+        all counted as alive at once, an upper bound of the peak memory
+        """
+        inputs, _, _ = self.get_batch(dataset.get_batch(np.arange(num)))
+        size = [sum(x.numel() * x.element_size() for x in inputs)]
+
+        def hook(module, args, output):
+            if torch.is_tensor(output):
+                size[0] += output.numel() * output.element_size()
+
+        handles = [module.register_forward_hook(hook) for module in self.model.modules()
+                   if next(module.children(), None) is None]
+        try:
+            with torch.inference_mode():
+                self.model(*inputs)
+        finally:
+            for handle in handles:
+                handle.remove()
+        return size[0]
+
+    def get_test_batch_size(self, dataset):
+        """
+        The largest testing batch whose peak memory fits in self.mem_budget
+
+        Peak memory is measured for the batch sizes in TEST_PROBES, memory per sample is the larger one of
+        (peak of the largest probe / its size) and the growth of peak between probes.
+        Sizes of leaf layer outputs are used if peak memory can not be measured
+        """
+        probes = sorted({min(num, len(dataset)) for num in TEST_PROBES})
+        peaks = [self.get_probe_mem(dataset, num) for num in probes]
+        per_sample = peaks[-1] / probes[-1]
+        if len(probes) > 1:
+            per_sample = max(per_sample, (peaks[-1] - peaks[0]) / (probes[-1] - probes[0]))
+        if per_sample <= 0:
+            per_sample = self.get_leaf_mem(dataset, probes[-1]) / probes[-1]
+        batch_size = int(np.clip(int(self.mem_budget * 1024 * 1024 / per_sample), 1,
+                                 min(len(dataset), MAX_TEST_BATCH)))
+        if batch_size < min(self.batch_size, len(dataset)):
+            print("Testing batch size {} is below batch_size {}, a sample takes {:.1f} MB of mem_budget {} MB".
+                  format(batch_size, self.batch_size, per_sample / 1024 / 1024, self.mem_budget))
+        return batch_size
+
     def read_data(self, train):
         """
         Read data for model training or testing
@@ -124,16 +317,80 @@ class Net(ABC):
         :param train: bool, True for Training set, False for Testing set
         :return: loader (Pytorch Dataloader), sm_scale (str)
         """
-        return None, None
+        data, rows, sm, df, sm_scale, idx_sm = self.load(train)
+        self.read_norm(df, train)
+        dataset = self.get_dataset(data, sm, df, rows)
+        if train:
+            return self.get_loader(dataset), sm_scale
+        return self.get_loader(dataset, self.get_test_batch_size(dataset), shuffle=False), sm_scale
 
-    @abstractmethod
-    def train_method(self, true, pred, train_loader, optimizer, criterion):
+    def read_norm(self, df, train):
+        """
+        Prepare statistics of features standardization, before get_dataset
+        """
+        return None
+
+    def get_batch(self, batch):
+        """
+        Unpack a batch of loader, and place it on device
+
+        :return: inputs of model (tuple), target of loss, true magnitudes
+        """
+        x, y, _ = batch
+        x, y = self.to_device(x), self.to_device(y)
+        return (x,), y, y
+
+    def to_mag(self, output):
+        """
+        Predicted magnitudes from output of model
+        """
+        return output
+
+    def to_device(self, x):
+        return x.to(self.device, non_blocking=self.non_blocking)
+
+    def get_autocast(self):
+        device_type = "cuda" if str(self.device).startswith("cuda") else "cpu"
+        dtype = torch.float16 if device_type == "cuda" else torch.bfloat16
+        return torch.autocast(device_type=device_type, dtype=dtype, enabled=self.amp)
+
+    def get_runner(self):
+        """
+        Model to be called in loop, compiled if self.compile
+        """
+        if self.compile:
+            return torch.compile(self.model)
+        return self.model
+
+    def train_method(self, acc, train_loader, optimizer, criterion, runner=None, scaler=None):
         """
         model training method during one epoch
 
-        :return: true magnitudes and predicted results
+        :return: PredAccumulator, filled with true magnitudes and predicted results
         """
-        return true, pred
+        runner = self.model if runner is None else runner
+        num_batch = len(train_loader)
+        optimizer.zero_grad()
+        for item, batch in enumerate(tqdm(train_loader)):
+            inputs, y, true = self.get_batch(batch)
+            with self.get_autocast():
+                output = runner(*inputs)
+                loss = criterion(output.float(), y) / self.accum_steps
+            if scaler is None:
+                loss.backward()
+            else:
+                scaler.scale(loss).backward()
+
+            if ((item + 1) % self.accum_steps == 0) or ((item + 1) == num_batch):
+                if scaler is None:
+                    optimizer.step()
+                else:
+                    scaler.step(optimizer)
+                    scaler.update()
+                optimizer.zero_grad()
+
+            acc.add(true, self.to_mag(output.float()))
+        return acc
 
     def training(self, input_data, model_name):
         """
@@ -148,32 +405,78 @@ class Net(ABC):
         criterion = torch.nn.MSELoss().to(self.device)
         optimizer = torch.optim.Adam(self.model.parameters(), lr=self.lr, weight_decay=self.decay)
         self.model.to(self.device)
+        self.model.train()
+        runner = self.get_runner()
+        # loss scaling is only needed by float16
+        scaler = torch.amp.GradScaler("cuda") if (self.amp and str(self.device).startswith("cuda")) else None
 
-        true, pred, loss_curve = [], [], []
+        acc, loss_curve = PredAccumulator(len(train_loader.dataset), self.device), []
         print("\n\n" + "=" * 20 + " Start {} Training ".format(self.model_name) + "=" * 20 + "\n")
         for epoch in range(self.epochs):
 
-            true, pred = self.train_method(true, pred, train_loader, optimizer, criterion)
-            rmse = net.cal_rmse_one_arr(true, pred)
-            r2 = net.cal_r2_one_arr(true, pred)
+            acc = self.train_method(acc.reset(), train_loader, optimizer, criterion, runner, scaler)
+            rmse, r2 = acc.cal_rmse(), acc.cal_r2()
             loss_curve.append((rmse ** 2))
             update_model_process(model_name, epoch, rmse, r2)
             print("Epoch: {:03d}  RMSE: {:.4f}  R2: {:.8f}".format(epoch, rmse, r2))
+        true, pred = acc.numpy()
 
-        pro.save_result("train", osp.join(self.re_ad, str(self.data_size)), true, pred,
+        pro.save_result("train", self.get_result_ad(), true, pred,
                         loss_curve, sm_scale, self.chunk_name, self.data_size_train,
                         self.data_size_test, self.model)
 
         return get_metrics(true, pred, self.model_name, self.sm_scale, self.data_size)
 
-    @abstractmethod
-    def test_method(self, true, pred, test_loader):
+    def test_method(self, acc, test_loader, runner=None):
         """
         model testing method during one epoch
 
-        :return: true magnitudes and predicted results
+        :return: PredAccumulator, filled with true magnitudes and predicted results
+        """
+        runner = self.model if runner is None else runner
+        with torch.inference_mode():
+            for batch in tqdm(test_loader):
+                inputs, _, true = self.get_batch(batch)
+                with self.get_autocast():
+                    output = runner(*inputs)
+                acc.add(true, self.to_mag(output.float()))
+        return acc
+
+    def get_train_df(self):
+        """
+        Rows of chunk.csv in Training set, of the magnitude scale sm_scale
+        """
+        _, index = pro.load_sample(self.root, self.data_size)
+        df = pro.read_meta(self.root, self.chunk_name).iloc[index, :].iloc[self.idx_train, :]
+        return df[np.isin(df["source_magnitude_type"].values, self.sm_scale)]
+
+    def init_predict(self):
+        """
+        Prepare the model for prediction, after read_test_params
+        """
+        self.model = ei_ew_device(self.model_name, self.model, self.device)
+        self.model.eval()
+        return None
+
+    def get_predict_inputs(self, x, info):
         """
-        return true, pred
+        Inputs of model from waveforms and information of request
+
+        :param x: Waveforms, shape (num, 3, 6000)
+        :param info: Dict of request, like: p_arrival_sample, s_arrival_sample, p_travel_sec
+        :return: tuple
+        """
+        return (x,)
+
+    def predict(self, x, info):
+        """
+        Predicted magnitudes of waveforms
+
+        :return: ndarray, shape (num,)
+        """
+        with torch.inference_mode():
+            output = self.model(*self.get_predict_inputs(x.to(self.device), info))
+            return self.to_mag(output).float().cpu().numpy().reshape(-1)
 
     def testing(self, input_data, model_name):
         """
@@ -184,40 +487,49 @@ class Net(ABC):
         init_model_process(model_name)
         self.read_test_params(input_data, model_name)
         self.model = ei_ew_device(self.model_name, self.model, self.device)
+        # Dropout and BatchNorm in inference behaviour
+        self.model.eval()
         test_loader, sm_scale = self.read_data(train=False)
 
-        true, pred, loss_curve = [], [], []
+        acc, loss_curve = PredAccumulator(len(test_loader.dataset), self.device), []
         print("\n\n" + "=" * 20 + "Start {} Testing".format(self.model_name) + "=" * 20 + "\n")
 
-        true, pred = self.test_method(true, pred, test_loader)
-        rmse = net.cal_rmse_one_arr(true, pred)
-        r2 = net.cal_r2_one_arr(true, pred)
+        start = time.perf_counter()
+        acc = self.test_method(acc, test_loader, self.get_runner())
+        rmse, r2 = acc.cal_rmse(), acc.cal_r2()
+        cost = time.perf_counter() - start
+        true, pred = acc.numpy()
         loss_curve.append((rmse ** 2))
         update_model_process(model_name, 0, rmse, r2)
         print("RMSE: {:.4f}  R2: {:.8f}".format(rmse, r2))
 
-        pro.save_result("test", osp.join(self.re_ad, str(self.data_size)), true, pred,
+        pro.save_result("test", self.get_result_ad(), true, pred,
                         loss_curve, sm_scale, self.chunk_name, self.data_size_train,
                         self.data_size_test)
 
-        return get_metrics(true, pred, self.model_name, self.sm_scale, self.data_size)
+        result = get_metrics(true, pred, self.model_name, self.sm_scale, self.data_size)
+        result.update(get_usage(true.shape[0], cost, test_loader.batch_size))
+        return result
 
 
-def load_data(root, chunk_name, data_size, idx, device, sm_scale):
+def load_data(root, chunk_name, data_size, idx, sm_scale):
     """
     generate dataset for model training or testing
+
+    The waveforms are not copied, the split and the sm_scale filter are composed into rows of the sample,
+    which are gathered batch by batch (and moved to device) by the loader
+
+    :return: data (whole sample), rows, sm, df, sm_scale, idx_sm
     """
-    data = torch.load(osp.join(root, str(data_size), "data.pt"))
-    index = torch.load(osp.join(root, str(data_size), "index.pt"))
-    if torch.is_tensor(index):
-        index = index.numpy()
-    df = pd.read_csv(osp.join(root, chunk_name + ".csv"))
-    df = df.iloc[index, :]
-
-    data = data[idx, :, :].float().to(device)
-    df = df.iloc[idx, :]
+    data, index = pro.load_sample(root, data_size)
+    df = pro.read_meta(root, chunk_name)
+    df = df.iloc[index[idx], :]
+
+    idx_sm, sm_scale = pro.get_sm_scale_idx(df, sm_scale)
+    rows = np.asarray(idx)[idx_sm]
+    df = df.iloc[idx_sm, :]
     sm = torch.from_numpy(df["source_magnitude"].values.reshape(-1)).float()
-    return pro.remain_sm_scale(data, df, sm, sm_scale)
+    return data, rows, sm, df, sm_scale, idx_sm
 
 
 def get_metrics(true, pred, model_name, sm_scale, data_size):
@@ -241,6 +553,45 @@ def get_metrics(true, pred, model_name, sm_scale, data_size):
     return result
 
 
+def reset_peak_rss():
+    """
+    Reset the peak RSS of this process to its current RSS, False if not supported (only on Linux)
+    """
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def read_rss():
+    """
+    Current and peak RSS (bytes) of this process, from /proc/self/status
+    """
+    rss = {}
+    with open("/proc/self/status", 'r') as f:
+        for line in f:
+            if line.startswith(("VmRSS:", "VmHWM:")):
+                rss[line[:5]] = int(line.split()[1]) * 1024
+    return rss["VmRSS"], rss["VmHWM"]
+
+
+def get_usage(num, cost, batch_size):
+    """
+    Throughput and peak memory of testing, for sizing the testing workers
+    """
+    # ru_maxrss is in KB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    usage = {
+        'batch_size': batch_size,
+        'samples_per_sec': str(np.round(num / max(cost, 1e-9), 1)),
+        'peak_rss_mb': str(np.round(peak_rss, 1)),
+    }
+    print(usage)
+    return usage
+
+
 def ei_ew_device(model_name, model, device):
     """
     Place the weights of GNN on given device (cpu or gpu)
@@ -279,6 +630,8 @@ def update_model_process(model_name, epoch, rmse, r2):
     model_status = DlModelStatus.objects.get(name=model_name)
     model_status.process = "epoch:{},rmse:{:.4f},r2:{:.4f}".format(epoch, rmse, r2)
     model_status.save()
+    # the job run by this worker process, if any
+    DlJob.objects.filter(pid=os.getpid(), situation="running").update(process=model_status.process)
     return None
 
 
@@ -288,152 +641,87 @@ class MagInfoNet(Net):
 
     def get_pt(self, df):
         """
-        get P and S wave arrival time
+        get P and S wave arrival time, standardized by statistics of Training set
         """
-        ps_at_name = ["p_arrival_sample", "s_arrival_sample"]
-        _, ps_at = pro.prep_pt("sta", df.loc[:, ps_at_name].values)
-        ps_at = torch.from_numpy(ps_at).float()
-
-        t_name = ["p_travel_sec"]
-        _, p_t = pro.prep_pt("sta", df.loc[:, t_name].values)
-        p_t = torch.from_numpy(p_t).float()
+        ps_at = pro.apply_norm(df.loc[:, PS_AT_NAME].values, self.norm["mean_at"], self.norm["std_at"])
+        p_t = pro.apply_norm(df.loc[:, P_T_NAME].values, self.norm["mean_t"], self.norm["std_t"])
         return ps_at, p_t
 
-    def read_data(self, train):
-        data, sm, df, sm_scale, idx_sm = self.load(train)
+    def get_norm_ad(self):
+        """
+        File of standardization statistics, saved next to model
+        """
+        return osp.join(self.get_result_ad(), "norm_{}_{}_{}_{}.npz".format(
+            self.sm_scale, self.chunk_name, self.data_size_train, self.data_size_test))
+
+    def cal_norm(self, df):
+        mean_at, std_at = pro.cal_norm(df.loc[:, PS_AT_NAME].values)
+        mean_t, std_t = pro.cal_norm(df.loc[:, P_T_NAME].values)
+        return {"mean_at": mean_at, "std_at": std_at, "mean_t": mean_t, "std_t": std_t}
+
+    def load_norm(self):
+        """
+        Saved statistics, or computed from Training set for models trained before they were saved
+        """
+        norm_ad = self.get_norm_ad()
+        if osp.exists(norm_ad):
+            with np.load(norm_ad) as f:
+                return {key: f[key] for key in f.files}
+        norm = self.cal_norm(self.get_train_df())
+        self.save_norm(norm)
+        return norm
+
+    def save_norm(self, norm):
+        if not osp.exists(self.get_result_ad()):
+            os.makedirs(self.get_result_ad())
+        np.savez(self.get_norm_ad(), **norm)
+        return None
+
+    def read_norm(self, df, train):
+        if train:
+            self.norm = self.cal_norm(df)
+            self.save_norm(self.norm)
+        else:
+            self.norm = self.load_norm()
+        return None
+
+    def get_dataset(self, data, sm, df, rows):
         ps_at, p_t = self.get_pt(df)
-        dataset = pro.SelfData(data, sm, ps_at, p_t)
-        loader = DataLoader(dataset, batch_size=self.batch_size, shuffle=True)
-        return loader, sm_scale
-
-    def train_method(self, true, pred, loader, optimizer, criterion):
-        for item, (x, y, ps_at, p_t, _) in enumerate(tqdm(loader)):
-            x, y = x.to(self.device), y.to(self.device)
-            ps_at, p_t = ps_at.to(self.device), p_t.to(self.device)
-
-            optimizer.zero_grad()
-            output = self.model(x, ps_at, p_t)
-            loss = criterion(output, y)
-            loss.backward()
-            optimizer.step()
-
-            pred_one = output.detach().cpu().numpy()
-            true_one = y.detach().cpu().numpy()
-            if item == 0:
-                pred = pred_one
-                true = true_one
-            else:
-                pred = np.concatenate((pred, pred_one), axis=0)
-                true = np.concatenate((true, true_one), axis=0)
-        return true, pred
-
-    def test_method(self, true, pred, test_loader):
-        for item, (x, y, ps_at, p_t, _) in enumerate(tqdm(test_loader)):
-            x, y = x.to(self.device), y.to(self.device)
-            ps_at, p_t = ps_at.to(self.device), p_t.to(self.device)
-
-            output = self.model(x, ps_at, p_t)
-            pred_one = output.detach().cpu().numpy()
-            true_one = y.detach().cpu().numpy()
-            if item == 0:
-                pred = pred_one
-                true = true_one
-            else:
-                pred = np.concatenate((pred, pred_one), axis=0)
-                true = np.concatenate((true, true_one), axis=0)
-        return true, pred
+        return pro.SelfData(data, sm, ps_at, p_t, rows=rows)
+
+    def init_predict(self):
+        super().init_predict()
+        self.norm = self.load_norm()
+        return None
+
+    def get_predict_inputs(self, x, info):
+        values = {name: np.asarray(info[name], dtype=float).reshape(-1) for name in PS_AT_NAME + P_T_NAME}
+        if any(value.shape[0] != x.shape[0] for value in values.values()):
+            raise ValueError("{} must have one value for each waveform".format(", ".join(PS_AT_NAME + P_T_NAME)))
+        df = pd.DataFrame(values)
+        ps_at, p_t = self.get_pt(df)
+        return x, ps_at.to(self.device), p_t.to(self.device)
+
+    def get_batch(self, batch):
+        x, y, ps_at, p_t, _ = batch
+        x, y, ps_at, p_t = self.to_device(x), self.to_device(y), self.to_device(ps_at), self.to_device(p_t)
+        return (x, ps_at, p_t), y, y
 
 
 class EQGraphNet(Net):
     def init_model(self):
         return net.EQGraphNet("gcn", "ts_un", 1, "cpu")
 
-    def read_data(self, train):
-        data, sm, df, sm_scale, idx_sm = self.load(train)
-        dataset = pro.SelfData(data, sm)
-        loader = DataLoader(dataset, batch_size=self.batch_size, shuffle=True)
-        return loader, sm_scale
-
-    def train_method(self, true, pred, train_loader, optimizer, criterion):
-        for item, (x, y, _) in enumerate(tqdm(train_loader)):
-            x, y = x.to(self.device), y.to(self.device)
-
-            optimizer.zero_grad()
-            output = self.model(x)
-            loss = criterion(output, y)
-            loss.backward()
-            optimizer.step()
-
-            pred_one = output.detach().cpu().numpy()
-            true_one = y.detach().cpu().numpy()
-            if item == 0:
-                pred = pred_one
-                true = true_one
-            else:
-                pred = np.concatenate((pred, pred_one), axis=0)
-                true = np.concatenate((true, true_one), axis=0)
-        return true, pred
-
-    def test_method(self, true, pred, test_loader):
-        for item, (x, y, _) in enumerate(tqdm(test_loader)):
-            x, y = x.to(self.device), y.to(self.device)
-
-            output = self.model(x)
-            pred_one = output.detach().cpu().numpy()
-            true_one = y.detach().cpu().numpy()
-            if item == 0:
-                pred = pred_one
-                true = true_one
-            else:
-                pred = np.concatenate((pred, pred_one), axis=0)
-                true = np.concatenate((true, true_one), axis=0)
-        return true, pred
+    def get_dataset(self, data, sm, df, rows):
+        return pro.SelfData(data, sm, rows=rows)
 
 
 class MagNet(Net):
     def init_model(self):
         return net.MagNet()
 
-    def read_data(self, train):
-        data, sm, df, sm_scale, idx_sm = self.load(train)
-        dataset = pro.SelfData(data, sm)
-        loader = DataLoader(dataset, batch_size=self.batch_size, shuffle=True)
-        return loader, sm_scale
-
-    def train_method(self, true, pred, train_loader, optimizer, criterion):
-        for item, (x, y, _) in enumerate(tqdm(train_loader)):
-            x, y = x.to(self.device), y.to(self.device)
-
-            optimizer.zero_grad()
-            output = self.model(x)
-            loss = criterion(output, y)
-            loss.backward()
-            optimizer.step()
-
-            pred_one = output.detach().cpu().numpy()
-            true_one = y.detach().cpu().numpy()
-            if item == 0:
-                pred = pred_one
-                true = true_one
-            else:
-                pred = np.concatenate((pred, pred_one), axis=0)
-                true = np.concatenate((true, true_one), axis=0)
-        return true, pred
-
-    def test_method(self, true, pred, test_loader):
-        for item, (x, y, _) in enumerate(tqdm(test_loader)):
-            x, y = x.to(self.device), y.to(self.device)
-
-            output = self.model(x)
-            pred_one = output.detach().cpu().numpy()
-            true_one = y.detach().cpu().numpy()
-            if item == 0:
-                pred = pred_one
-                true = true_one
-            else:
-                pred = np.concatenate((pred, pred_one), axis=0)
-                true = np.concatenate((true, true_one), axis=0)
-        return true, pred
+    def get_dataset(self, data, sm, df, rows):
+        return pro.SelfData(data, sm, rows=rows)
 
 
 class CREIME(Net):
@@ -445,111 +733,57 @@ class CREIME(Net):
         mag = torch.mean(output_last, dim=1)
         return mag
 
-    def get_xy(self, data, df, sm, p_len):
-        data, sm = data.detach().cpu().numpy(), sm.detach().cpu().numpy()
-        num = data.shape[0]
-        p_as = df.loc[:, "p_arrival_sample"].values.reshape(-1).astype(int)
+    def get_window(self, data, p_as, p_len):
+        """
+        512 samples window ending p_len samples after P arrival, or the first 512 samples if P arrives earlier,
+        gathered for all waveforms at once
+
+        :param data: Waveforms, tensor (num, 3, length)
+        :param p_as: P arrival samples, tensor (num,)
+        :return: x (num, 3, 512), onset (num,) position of P arrival in window
+        """
         n_len = 512 - p_len
-        y_n_i = np.ones(shape=(1, n_len)) * (-4)
-        x, y = np.zeros(shape=(num, 3, 512)), np.zeros(shape=(num, 512))
-        for i in range(num):
-            p_as_i, sm_i = p_as[i], sm[i]
-            if p_as_i > n_len:
-                x_i = data[i, :, (p_as_i - n_len): (p_as_i + p_len)]
-                y_i = np.hstack([y_n_i, np.ones(shape=(1, p_len)) * sm_i])
-            else:
-                x_i = data[i, :, :512]
-                y_i = np.hstack([np.ones(shape=(1, p_as_i)) * (-4), np.ones(shape=(1, 512 - p_as_i)) * sm_i])
+        p_as = p_as.to(data.device).long().reshape(-1)
+        start = (p_as - n_len).clamp(min=0, max=data.shape[-1] - 512)
+        idx = start.view(-1, 1) + torch.arange(512, device=data.device)
+        x = torch.gather(data, 2, idx.unsqueeze(1).expand(-1, data.shape[1], -1))
+        return x, p_as - start
 
-            x[i, :, :] = x_i
-            y[i, :] = y_i
-        x, y = torch.from_numpy(x).float(), torch.from_numpy(y).float()
-        return x, y
+    def get_label(self, sm, onset):
+        """
+        Label of window, -4 before P arrival and magnitude after it
+        """
+        pos = torch.arange(512, device=sm.device).view(1, -1)
+        return torch.where(pos < onset.view(-1, 1), torch.full_like(pos, -4, dtype=sm.dtype), sm.view(-1, 1))
 
-    def read_data(self, train):
-        data, sm, df, sm_scale, idx_sm = self.load(train)
-        x, y = self.get_xy(data, df, sm, 125)
-        dataset = pro.SelfData(x, y, sm)
-        loader = DataLoader(dataset, batch_size=self.batch_size, shuffle=True)
-        return loader, sm_scale
-
-    def train_method(self, true, pred, train_loader, optimizer, criterion):
-        for item, (x, y, sm, _) in enumerate(tqdm(train_loader)):
-            x, y, sm = x.to(self.device), y.to(self.device), sm.to(self.device)
-
-            optimizer.zero_grad()
-            output = self.model(x)
-            loss = criterion(output, y)
-            loss.backward()
-            optimizer.step()
-
-            pred_one = self.cal_mag(output).detach().cpu().numpy()
-            true_one = sm.detach().cpu().numpy()
-            if item == 0:
-                pred = pred_one
-                true = true_one
-            else:
-                pred = np.concatenate((pred, pred_one), axis=0)
-                true = np.concatenate((true, true_one), axis=0)
-        return true, pred
-
-    def test_method(self, true, pred, test_loader):
-        for item, (x, y, sm, _) in enumerate(tqdm(test_loader)):
-            x, y, sm = x.to(self.device), y.to(self.device), sm.to(self.device)
-
-            output = self.model(x)
-            pred_one = self.cal_mag(output).detach().cpu().numpy()
-            true_one = sm.detach().cpu().numpy()
-            if item == 0:
-                pred = pred_one
-                true = true_one
-            else:
-                pred = np.concatenate((pred, pred_one), axis=0)
-                true = np.concatenate((true, true_one), axis=0)
-        return true, pred
+    def get_dataset(self, data, sm, df, rows):
+        # windows are cut from each batch in get_batch, not for the whole set in advance
+        p_as = torch.from_numpy(df.loc[:, "p_arrival_sample"].values.reshape(-1).astype(int))
+        return pro.SelfData(data, sm, p_as, rows=rows)
+
+    def get_batch(self, batch):
+        data, sm, p_as, _ = batch
+        data, sm = self.to_device(data), self.to_device(sm)
+        x, onset = self.get_window(data, p_as, 125)
+        return (x,), self.get_label(sm, onset), sm
+
+    def to_mag(self, output):
+        return self.cal_mag(output)
+
+    def get_predict_inputs(self, x, info):
+        p_as = np.asarray(info["p_arrival_sample"], dtype=float).reshape(-1).astype(int)
+        if p_as.shape[0] != x.shape[0]:
+            raise ValueError("p_arrival_sample must have one value for each waveform")
+        if np.any(p_as < 0) or np.any(p_as >= x.shape[-1]):
+            raise ValueError("P arrival is out of waveform")
+        x, _ = self.get_window(x, torch.from_numpy(p_as), 125)
+        return (x,)
 
 
 class ConvNetQuakeINGV(Net):
     def init_model(self):
         return net.ConvNetQuakeINGV()
 
-    def read_data(self, train):
-        data, sm, df, sm_scale, idx_sm = self.load(train)
-        dataset = pro.SelfData(data, sm)
-        loader = DataLoader(dataset, batch_size=self.batch_size, shuffle=True)
-        return loader, sm_scale
-
-    def train_method(self, true, pred, train_loader, optimizer, criterion):
-        for item, (x, y, _) in enumerate(tqdm(train_loader)):
-            x, y = x.to(self.device), y.to(self.device)
-
-            optimizer.zero_grad()
-            output = self.model(x)
-            loss = criterion(output, y)
-            loss.backward()
-            optimizer.step()
-
-            pred_one = output.detach().cpu().numpy()
-            true_one = y.detach().cpu().numpy()
-            if item == 0:
-                pred = pred_one
-                true = true_one
-            else:
-                pred = np.concatenate((pred, pred_one), axis=0)
-                true = np.concatenate((true, true_one), axis=0)
-        return true, pred
-
-    def test_method(self, true, pred, test_loader):
-        for item, (x, y, _) in enumerate(tqdm(test_loader)):
-            x, y = x.to(self.device), y.to(self.device)
-
-            output = self.model(x)
-            pred_one = output.detach().cpu().numpy()
-            true_one = y.detach().cpu().numpy()
-            if item == 0:
-                pred = pred_one
-                true = true_one
-            else:
-                pred = np.concatenate((pred, pred_one), axis=0)
-                true = np.concatenate((true, true_one), axis=0)
-        return true, pred
+    def get_dataset(self, data, sm, df, rows):
+        return pro.SelfData(data, sm, rows=rows)
+
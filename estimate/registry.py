@@ -1,17 +1,27 @@
+import json
 from .models import *
+from .jobs import JobQueue, MAX_JOBS, MAX_MODEL_JOBS, is_job_alive
+from .serving import ModelPool, MicroBatcher
 
 
 class DlRegistry:
     """
     Initialize Magnitude Estimation Model, when starting service
+
+    models keeps the Net class of each model, train/test jobs are run by scheduler,
+    and every job creates its own Net object in its worker process,
+    pool keeps trained models loaded for prediction, and batcher runs concurrent predictions together
     """
 
-    def __init__(self):
+    def __init__(self, max_jobs=MAX_JOBS):
         self.models = {}
         self.users = {}
+        self.scheduler = JobQueue(max_jobs=max_jobs)
+        self.pool = ModelPool()
+        self.batcher = MicroBatcher(self.pool)
 
     def add_model(self, model_object, name, description, owner, path_data, library,
-                  code_data, code_model, code_train, code_test, code_run):
+                  code_data, code_model, code_train, code_test, code_run, max_jobs=MAX_MODEL_JOBS):
 
         if not DlModel.objects.filter(name=name).exists():
             database_object, created = DlModel.objects.get_or_create(
@@ -35,6 +45,7 @@ class DlRegistry:
             database_object, _ = DlModel.objects.get_or_create(name=name)
 
         self.models[database_object.id] = model_object
+        self.scheduler.max_model[name] = max_jobs
         print("Successfully Load Model: {}".format(name))
         return None
 
@@ -60,6 +71,13 @@ class DlRegistry:
         """
         Initialize model information
         """
-        DlModel.objects.all().update(situation="Free")
+        # jobs left running by the last service have lost their workers,
+        # jobs run by other processes of web server are kept
+        for job in DlJob.objects.filter(situation="running"):
+            if not is_job_alive(job):
+                DlJob.objects.filter(pk=job.pk, situation="running").update(
+                    situation="failed", result=json.dumps({"error": "Service restarted"}))
+        running = DlJob.objects.filter(situation="running").values_list('name', flat=True)
+        DlModel.objects.exclude(name__in=list(running)).update(situation="Free")
         # ModelStatus.objects.all().update(process="")
         return None
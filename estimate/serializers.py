@@ -28,6 +28,13 @@ class DlModelStatusSerializer(serializers.ModelSerializer):
         fields = ('pk', 'name', 'process')
 
 
+class DlJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DlJob
+        fields = ('pk', 'name', 'opt', 'params', 'situation', 'process', 'result', 'sweep', 'created_at',
+                  'started_at', 'finished_at')
+
+
 class FeatureSerializer(serializers.ModelSerializer):
     class Meta:
         model = Feature
@@ -45,6 +52,14 @@ class SourceSerializer(serializers.Serializer):
     Magnitude = serializers.FloatField()
 
 
+class TileSerializer(serializers.Serializer):
+    Longitude = serializers.FloatField()
+    Latitude = serializers.FloatField()
+    Count = serializers.IntegerField()
+    Magnitude = serializers.FloatField()
+    MaxMagnitude = serializers.FloatField()
+
+
 class ResultSerializer(serializers.Serializer):
     points = PointSerializer(many=True)
     r2 = serializers.FloatField()
@@ -0,0 +1,207 @@
+import time
+import queue
+import threading
+import numpy as np
+import torch
+from collections import OrderedDict
+
+POOL_SIZE = 8
+MAX_BATCH = 64
+MAX_WAIT_MS = 5.0
+LATENCY_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000]
+PREDICT_INFO = ["p_arrival_sample", "s_arrival_sample", "p_travel_sec"]
+POOL_PARAMS = ["sm_scale", "chunk_name", "data_size", "train_ratio", "tag"]
+
+
+def get_waveforms(waveforms):
+    """
+    Waveforms of request as float32 tensor, shape (num, 3, 6000)
+    """
+    x = torch.from_numpy(np.asarray(waveforms, dtype=np.float32))
+    if x.dim() == 2:
+        x = x.unsqueeze(0)
+    if x.dim() != 3 or tuple(x.shape[1:]) != (3, 6000):
+        raise ValueError("Waveforms must be in shape (num, 3, 6000)")
+    return x
+
+
+def get_pool_key(name, params):
+    """
+    Models trained on the same data set with the same params share one key
+    """
+    data_size = int(params["data_size"])
+    data_size_train = int(data_size * float(params["train_ratio"]))
+    return (name, str(params["sm_scale"]), str(params["chunk_name"]), data_size, data_size_train,
+            str(params.get("tag", "")))
+
+
+class ModelPool:
+    """
+    Trained models kept in memory in eval mode, for prediction
+
+    Models are keyed by (model, sm_scale, chunk, sizes, tag), the least recently used one is evicted
+    when more than size models are loaded
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, name, params):
+        """
+        Get the loaded model, the checkpoint is loaded at first time
+
+        :param name: Model name, like: MagInfoNet, EQGraphNet, MagNet
+        :param params: Dict with sm_scale, chunk_name, data_size, train_ratio, and tag of sweep (optional)
+        :return: Net object
+        """
+        import estimate.network as network
+        key = get_pool_key(name, params)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+        net_object = getattr(network, name)()
+        net_object.read_test_params({key: params[key] for key in POOL_PARAMS if key in params}, name)
+        net_object.init_predict()
+        with self.lock:
+            self.models[key] = net_object
+            self.models.move_to_end(key)
+            while len(self.models) > self.size:
+                self.models.popitem(last=False)
+        return net_object
+
+    def predict(self, name, params, waveforms, info):
+        """
+        Predict magnitudes of waveforms
+
+        :param waveforms: ndarray, shape (num, 3, 6000) or (3, 6000)
+        :param info: Dict of request, arrival times for MagInfoNet and CREIME
+        :return: ndarray of magnitudes, shape (num,)
+        """
+        net_object = self.get(name, params)
+        return net_object.predict(get_waveforms(waveforms), info)
+
+
+class PredictRequest:
+    def __init__(self, x, info):
+        self.x = x
+        self.info = {key: np.asarray(info[key], dtype=float).reshape(-1) for key in PREDICT_INFO if key in info}
+        self.start = time.perf_counter()
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+    """
+    Coalesce concurrent prediction requests of the same model into one forward pass
+
+    Requests are queued per pool key, a thread of each key takes the first waiting request,
+    then waits up to max_wait_ms for more, until max_batch waveforms are collected
+    """
+
+    def __init__(self, pool, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+        self.queues = {}
+        self.lock = threading.Lock()
+        self.num_request, self.num_batch = 0, 0
+        self.hist_batch = {}
+        self.hist_latency = [0] * (len(LATENCY_MS) + 1)
+
+    def predict(self, name, params, waveforms, info):
+        """
+        The same as ModelPool.predict, blocked until the micro-batch of request is done
+        """
+        x = get_waveforms(waveforms)
+        # load the model in request thread, so that errors of checkpoint are raised here
+        self.pool.get(name, params)
+        request = PredictRequest(x, info)
+        self.get_queue(name, params).put(request)
+        request.event.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def get_queue(self, name, params):
+        key = get_pool_key(name, params)
+        with self.lock:
+            if key not in self.queues:
+                self.queues[key] = queue.Queue()
+                thread = threading.Thread(target=self.loop, args=(self.queues[key], name, dict(params)), daemon=True)
+                thread.start()
+            return self.queues[key]
+
+    def loop(self, requests, name, params):
+        while True:
+            batch = [requests.get()]
+            size = batch[0].x.shape[0]
+            deadline = time.perf_counter() + self.max_wait_ms / 1000
+            while size < self.max_batch:
+                remain = deadline - time.perf_counter()
+                if remain <= 0:
+                    break
+                try:
+                    request = requests.get(timeout=remain)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                size = size + request.x.shape[0]
+            self.run(batch, name, params)
+
+    def run(self, batch, name, params):
+        """
+        One forward pass for the batch, results are scattered back to requests
+        """
+        try:
+            net_object = self.pool.get(name, params)
+            x = torch.cat([request.x for request in batch], dim=0)
+            keys = [key for key in PREDICT_INFO if all(key in request.info for request in batch)]
+            info = {key: np.concatenate([request.info[key] for request in batch]) for key in keys}
+            pred = net_object.predict(x, info)
+            sections = np.cumsum([request.x.shape[0] for request in batch])[:-1]
+            for request, result in zip(batch, np.split(pred, sections)):
+                request.result = result
+        except Exception as e:
+            if len(batch) > 1:
+                # find the failed request, by running one by one
+                for request in batch:
+                    self.run([request], name, params)
+                return None
+            batch[0].error = e
+        self.record(batch)
+        for request in batch:
+            request.event.set()
+        return None
+
+    def record(self, batch):
+        now = time.perf_counter()
+        with self.lock:
+            self.num_batch = self.num_batch + 1
+            self.num_request = self.num_request + len(batch)
+            size = sum(request.x.shape[0] for request in batch)
+            self.hist_batch[size] = self.hist_batch.get(size, 0) + 1
+            for request in batch:
+                self.hist_latency[np.searchsorted(LATENCY_MS, (now - request.start) * 1000)] += 1
+        return None
+
+    def get_stats(self):
+        """
+        Queue depth of each model, histograms of batch size and latency (ms)
+        """
+        with self.lock:
+            latency = {"<={}".format(edge): num for edge, num in zip(LATENCY_MS, self.hist_latency)}
+            latency[">{}".format(LATENCY_MS[-1])] = self.hist_latency[-1]
+            return {
+                "max_batch": self.max_batch,
+                "max_wait_ms": self.max_wait_ms,
+                "num_request": self.num_request,
+                "num_batch": self.num_batch,
+                "queue_depth": {"_".join(str(one) for one in key if one != ""): requests.qsize()
+                                for key, requests in self.queues.items()},
+                "batch_size": {str(size): num for size, num in sorted(self.hist_batch.items())},
+                "latency_ms": latency,
+            }
@@ -2,14 +2,38 @@ import torch
 import numpy as np
 import os
 import inspect
+import tempfile
+import threading
+from unittest import mock
+import h5py
+import pandas as pd
 import django
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "web.settings")
 django.setup()
 from django.test import TestCase
-from estimate.network import MagNet
+from estimate.network import MagNet, CREIME, PredAccumulator
 from estimate.registry import DlRegistry
-from func.process import get_lib_by_files, duplicate_lib, get_source
-from func.net import MagInfoNet
+from estimate.serving import MicroBatcher
+import func.process as pro
+import estimate.network as network
+from func.process import get_lib_by_files, duplicate_lib, get_source, SelfData, get_train_or_test_idx, \
+    grow_store, load_sample, parse_snr, hist_from_sorted
+from func.net import MagInfoNet, EQGraphNet, run_gnn, run_gnn_each, get_edge, ts_un, tg, tran_adm_to_edge_index, \
+    cal_rmse_one_arr, cal_r2_one_arr
+
+
+
+def write_chunk(root, num, seed=0):
+    """
+    chunk.csv of num epicenters in root, half of them around (25, -5)
+    """
+    rng = np.random.default_rng(seed)
+    la = np.concatenate([rng.uniform(-80, 80, num - num // 2), rng.normal(25, 8, num // 2)])
+    lo = np.concatenate([rng.uniform(-179, 179, num - num // 2), rng.normal(-5, 15, num // 2)])
+    sm = rng.uniform(0, 5, num)
+    pd.DataFrame({"trace_name": ["trace_{}".format(i) for i in range(num)], "source_latitude": la,
+                  "source_longitude": lo, "source_magnitude": sm}).to_csv(os.path.join(root, "chunk.csv"), index=False)
+    return la, lo, sm
 
 
 class DlTests(TestCase):
@@ -21,6 +45,284 @@ class DlTests(TestCase):
         y = Mag.model(x)
         self.assertEquals(torch.is_tensor(y), True)
 
+    def test_unimp_batched(self):
+        torch.manual_seed(0)
+        model = MagInfoNet("unimp", "ts_un", 1, "cpu")
+        for batch_size in [1, 16]:
+            x = torch.rand(batch_size, 600, 32)
+            with torch.no_grad():
+                h_batch = run_gnn("unimp", model.gnn1, x, model.ei1, model.ew1)
+                h_loop = run_gnn_each(model.gnn1, x, model.ei1)
+            self.assertEquals(h_batch.shape, (batch_size, 600, 32))
+            self.assertTrue(torch.equal(h_batch, h_loop))
+
+    def test_get_edge(self):
+        for n in [1, 2, 5, 600]:
+            for k in [1, 2]:
+                ei, ew = tran_adm_to_edge_index(ts_un(n, k))
+                ei_sparse, ew_sparse = get_edge(k, n, "ts_un")
+                self.assertTrue(torch.equal(ei, ei_sparse) and torch.equal(ew, ew_sparse))
+            ei, ew = tran_adm_to_edge_index(tg(n))
+            ei_sparse, ew_sparse = get_edge(1, n, "tg")
+            self.assertTrue(torch.equal(ei, ei_sparse) and torch.equal(ew, ew_sparse))
+
+    def test_banded_gcn(self):
+        torch.manual_seed(0)
+        model_gcn = EQGraphNet("gcn", "ts_un", 1, "cpu")
+        model_banded = EQGraphNet("banded", "ts_un", 1, "cpu")
+        model_banded.load_state_dict(model_gcn.state_dict())
+        x = torch.rand(4, 3, 6000)
+        y_gcn, y_banded = model_gcn(x), model_banded(x)
+        self.assertTrue(torch.allclose(y_gcn, y_banded, atol=1e-5))
+        y_gcn.sum().backward()
+        y_banded.sum().backward()
+        self.assertTrue(torch.allclose(model_gcn.ew1.grad, model_banded.ew1.grad, atol=1e-5))
+
+    def test_creime_window(self):
+        data, sm = torch.rand(6, 3, 6000), torch.rand(6) * 5
+        p_as = np.array([0, 100, 387, 388, 3000, 5875])
+        x, onset = CREIME().get_window(data, torch.from_numpy(p_as), 125)
+        y = CREIME().get_label(sm, onset)
+        for i in range(6):
+            if p_as[i] > 387:
+                x_i = data[i, :, (p_as[i] - 387): (p_as[i] + 125)]
+                y_i = np.hstack([np.ones(387) * (-4), np.ones(125) * sm[i].item()])
+            else:
+                x_i = data[i, :, :512]
+                y_i = np.hstack([np.ones(p_as[i]) * (-4), np.ones(512 - p_as[i]) * sm[i].item()])
+            self.assertTrue(torch.equal(x[i], x_i))
+            self.assertTrue(np.allclose(y[i].numpy(), y_i))
+
+    def test_self_data_rows(self):
+        data, sm = np.random.rand(10, 3, 60).astype(np.float32), torch.rand(10)
+        rows = np.array([7, 2, 9, 4])
+        dataset = SelfData(data, sm[rows], rows=rows)
+        x, y, idx = dataset.get_batch(np.array([3, 0, 1]))
+        self.assertEquals(len(dataset), 4)
+        self.assertTrue(torch.equal(x, torch.from_numpy(data[[4, 7, 2]])))
+        self.assertTrue(torch.equal(y, sm[[4, 7, 2]]))
+        self.assertTrue(torch.equal(dataset[2][0], torch.from_numpy(data[9])))
+
+    def test_split(self):
+        for num, num_train in [(100, 75), (1000, 800)]:
+            np.random.seed(100)
+            idx_train_old = np.random.choice(num, num_train, replace=False)
+            idx_test_old = np.array(list(set(np.arange(num)) - set(idx_train_old)))
+            idx_train, idx_test = get_train_or_test_idx(num, num_train)
+            self.assertTrue(np.array_equal(idx_train, idx_train_old))
+            self.assertTrue(np.array_equal(idx_test, np.sort(idx_test_old)))
+
+    def test_grow_store(self):
+        with tempfile.TemporaryDirectory() as root:
+            names = np.array(["trace_{}".format(i) for i in range(10)])
+            traces = np.random.rand(10, 6000, 3).astype(np.float32)
+            pd.DataFrame({"trace_name": names}).to_csv(os.path.join(root, "chunk.csv"), index=False)
+            with h5py.File(os.path.join(root, "chunk.hdf5"), 'w') as f:
+                for name, trace in zip(names, traces):
+                    f.create_dataset("data/" + name, data=trace)
+            for data_size, count in [(4, 4), (7, 7), (5, 7)]:
+                self.assertEquals(grow_store(root, "chunk", data_size, num_workers=1), count)
+                data, index = load_sample(root, data_size)
+                self.assertEquals(data.shape, (data_size, 3, 6000))
+                self.assertTrue(np.array_equal(data, traces[index].transpose(0, 2, 1)))
+            self.assertEquals(len(set(index)), 5)
+            self.assertTrue(np.array_equal(load_sample(root, 7)[1][:5], index))
+
+            # a changed chunk.csv pairs rows with other traces, the store is built again
+            order = np.random.permutation(10)
+            names, traces = names[order], traces[order]
+            csv_ad = os.path.join(root, "chunk.csv")
+            pd.DataFrame({"trace_name": names}).to_csv(csv_ad, index=False)
+            os.utime(csv_ad, ns=(os.stat(csv_ad).st_atime_ns, os.stat(csv_ad).st_mtime_ns + 10 ** 9))
+            with self.assertRaises(FileNotFoundError):
+                load_sample(root, 5)
+            self.assertEquals(grow_store(root, "chunk", 5, num_workers=1), 5)
+            data, index = load_sample(root, 5)
+            self.assertTrue(np.array_equal(data, traces[index].transpose(0, 2, 1)))
+
+    def test_parse_snr(self):
+        snr = parse_snr(np.array(["[56.79999924 55.40000153 47.40000153]", np.nan, "", "[1.5 2.5]"], dtype=object))
+        self.assertEquals(snr.shape, (4, 3))
+        self.assertTrue(np.allclose(snr[0], [56.8, 55.4, 47.4]))
+        self.assertTrue(np.all(np.isnan(snr[1:])))
+        # a row of 4 values does not shift the rows after it
+        snr = parse_snr(np.array(["[1 2 3]", "[4 5 6 7]", "[7 8]", "[ 9.  10  11]", "[1 a 3]"]))
+        self.assertTrue(np.array_equal(snr[[0, 3]], [[1, 2, 3], [9, 10, 11]]))
+        self.assertTrue(np.all(np.isnan(snr[[1, 2, 4]])))
+
+    def test_hist_from_sorted(self):
+        def cut(values, bins, v_min=None, v_max=None):
+            if v_min is not None:
+                values = np.append(values[values >= v_min], v_min)
+            if v_max is not None:
+                values = np.append(values[values <= v_max], v_max)
+            label = pd.cut(values, bins=bins)
+            y = pd.Series(label).value_counts(sort=False).to_numpy().copy()
+            y[0] = y[0] - (v_min is not None)
+            y[-1] = y[-1] - (v_max is not None)
+            return (label.categories.left + label.categories.right) / 2, y
+
+        rng = np.random.default_rng(0)
+        cases = [(rng.normal(2, 1.5, 1000), 20, None, None), (rng.normal(2, 1.5, 1000), 7, 0.5, 3.2),
+                 (rng.uniform(0, 300, 500), 50, None, 100), (np.full(30, -0.6935), 16, None, None),
+                 (np.full(30, 0.0), 10, None, None), (np.full(30, 123456.7), 5, None, None)]
+        for values, bins, v_min, v_max in cases:
+            x, y = hist_from_sorted(np.sort(values), bins, v_min, v_max)
+            x_true, y_true = cut(values, bins, v_min, v_max)
+            self.assertTrue(np.allclose(x, x_true, rtol=0, atol=1e-12))
+            self.assertTrue(np.array_equal(y, y_true))
+            self.assertEquals(np.unique(x).shape[0], bins)
+
+    def test_pred_accumulator(self):
+        torch.manual_seed(0)
+        true, pred = torch.rand(100) * 5, torch.rand(100) * 5
+        acc = PredAccumulator(100, "cpu")
+        for start, end in [(0, 16), (16, 48), (48, 64), (64, 100)]:
+            acc.add(true[start:end], pred[start:end].reshape(-1, 1))
+        true_np, pred_np = acc.numpy()
+        self.assertTrue(np.array_equal(true_np, true.numpy()))
+        self.assertTrue(np.array_equal(pred_np, pred.numpy()))
+        self.assertAlmostEqual(acc.cal_rmse(), cal_rmse_one_arr(true.double().numpy(), pred.double().numpy()))
+        self.assertAlmostEqual(acc.cal_r2(), cal_r2_one_arr(true.double().numpy(), pred.double().numpy()))
+        acc.reset()
+        acc.add(true[:10], pred[:10])
+        self.assertAlmostEqual(acc.cal_rmse(), cal_rmse_one_arr(true[:10].double().numpy(), pred[:10].double().numpy()))
+
+    def test_load_checkpoint(self):
+        pro._CKPT["cache"].clear()
+        pro._CKPT["bytes"] = 0
+        with tempfile.TemporaryDirectory() as root, mock.patch.object(pro, "CKPT_MB", 1):
+            # about 0.4 MB each, 2 of them are kept
+            paths = [os.path.join(root, "model_{}.pkl".format(i)) for i in range(3)]
+            for i, path in enumerate(paths):
+                torch.save({"w": torch.full((100000,), float(i))}, path)
+            for path in paths:
+                pro.load_checkpoint(path)
+            miss = pro.get_checkpoint_stats()["miss"]
+            self.assertEquals(pro.get_checkpoint_stats()["num"], 2)
+            pro.load_checkpoint(paths[2])
+            self.assertEquals(pro.get_checkpoint_stats()["miss"], miss)
+            pro.load_checkpoint(paths[0])
+            self.assertEquals(pro.get_checkpoint_stats()["miss"], miss + 1)
+
+            # a newer file of the same path is loaded again
+            torch.save({"w": torch.full((100000,), 7.0)}, paths[0])
+            os.utime(paths[0], ns=(os.stat(paths[0]).st_atime_ns, os.stat(paths[0]).st_mtime_ns + 10 ** 9))
+            self.assertEquals(pro.load_checkpoint(paths[0])["w"][0].item(), 7.0)
+            self.assertEquals(pro.get_checkpoint_stats()["miss"], miss + 2)
+
+    def test_mag_info_net_norm(self):
+        rng = np.random.default_rng(0)
+        df = pd.DataFrame({"p_arrival_sample": rng.uniform(100, 1000, 50),
+                           "s_arrival_sample": rng.uniform(1000, 3000, 50), "p_travel_sec": rng.uniform(1, 20, 50)})
+        with tempfile.TemporaryDirectory() as re_ad:
+            model_train = network.MagInfoNet()
+            model_train.re_ad, model_train.model_name = re_ad, "MagInfoNet"
+            model_train.read_norm(df, True)
+            self.assertTrue(os.path.exists(model_train.get_norm_ad()))
+
+            model_predict = network.MagInfoNet()
+            model_predict.re_ad, model_predict.model_name = re_ad, "MagInfoNet"
+            model_predict.init_predict()
+            for key, value in model_train.norm.items():
+                self.assertTrue(np.array_equal(model_predict.norm[key], value))
+            ps_at, p_t = model_predict.get_pt(df)
+            self.assertTrue(np.allclose(ps_at.numpy().mean(axis=0), 0, atol=1e-5))
+            self.assertTrue(np.allclose(p_t.numpy().std(axis=0), 1, atol=1e-4))
+
+    def test_locate_source(self):
+        with tempfile.TemporaryDirectory() as root:
+            la, lo, _ = write_chunk(root, 1500)
+            la_min, la_max, lo_min, lo_max = 10.0, 40.0, -30.0, 20.0
+            inside = np.flatnonzero((la >= la_min) & (la <= la_max) & (lo >= lo_min) & (lo <= lo_max))
+
+            # at or above the number of matches, every match is returned
+            for num in [inside.shape[0], inside.shape[0] + 100]:
+                idx = pro.locate_source(root, "chunk", la_min, la_max, lo_min, lo_max, num)
+                self.assertTrue(np.array_equal(np.sort(idx), inside))
+
+            num = 100
+            idx = pro.locate_source(root, "chunk", la_min, la_max, lo_min, lo_max, num)
+            self.assertTrue(np.array_equal(idx, pro.locate_source(root, "chunk", la_min, la_max, lo_min, lo_max, num)))
+            self.assertEquals(idx.shape[0], num)
+            self.assertEquals(np.unique(idx).shape[0], num)
+            self.assertTrue(np.all(np.isin(idx, inside)))
+            cell, count = np.unique(pro.get_cell(la[inside], lo[inside]), return_counts=True)
+            cell_idx = pro.get_cell(la[idx], lo[idx])
+            for cell_one, count_one in zip(cell, count):
+                share = count_one * num / inside.shape[0]
+                self.assertIn(np.sum(cell_idx == cell_one), [np.floor(share), np.ceil(share)])
+
+    def test_micro_batcher(self):
+        calls = []
+
+        class FakeNet:
+            def predict(self, x, info):
+                calls.append(x.shape[0])
+                p = info["p_arrival_sample"]
+                if p.shape[0] != x.shape[0]:
+                    raise ValueError("Length of p_arrival_sample must be the same as waveforms")
+                return x[:, 0, 0].numpy() + p
+
+        class FakePool:
+            def get(self, name, params):
+                return FakeNet()
+
+        params = {"sm_scale": "ml", "chunk_name": "chunk2", "data_size": 200, "train_ratio": 0.75}
+        batcher = MicroBatcher(FakePool(), max_wait_ms=500)
+        num = 6
+        # request i has i + 1 waveforms of value i, the third one has one arrival too many
+        sizes = [i + 1 for i in range(num)]
+        p = [np.arange(size) * 10.0 for size in sizes]
+        p[2] = np.arange(sizes[2] + 1) * 10.0
+        results, errors = [None] * num, [None] * num
+        barrier = threading.Barrier(num)
+
+        def send(i):
+            barrier.wait()
+            try:
+                results[i] = batcher.predict("MagInfoNet", params, np.full((sizes[i], 3, 6000), float(i)),
+                                             {"p_arrival_sample": p[i]})
+            except ValueError as e:
+                errors[i] = e
+
+        threads = [threading.Thread(target=send, args=(i,)) for i in range(num)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # the first forward pass holds several requests, then the failed batch is run one by one
+        self.assertTrue(calls[0] > sizes[-1])
+        for i in range(num):
+            if i == 2:
+                self.assertIsInstance(errors[i], ValueError)
+                self.assertIsNone(results[i])
+            else:
+                self.assertIsNone(errors[i])
+                self.assertTrue(np.allclose(results[i], i + p[i]))
+
+    def test_read_tile(self):
+        with tempfile.TemporaryDirectory() as root:
+            _, _, sm = write_chunk(root, 1500)
+            _, _, count, mean, peak = pro.read_tile(root, "chunk", 0, 0, 0)
+            self.assertEquals(np.sum(count), 1500)
+            self.assertTrue(np.isclose(np.sum(count * mean), np.sum(sm)))
+            self.assertTrue(np.isclose(np.max(peak), np.max(sm)))
+
+            for zoom, x, y in [(0, 0, 0), (1, 0, 0), (1, 1, 0), (2, 1, 1), (pro.TILE_ZOOM - 1, 14, 12)]:
+                _, _, count, mean, peak = pro.read_tile(root, "chunk", zoom, x, y)
+                num, total, peak_child = 0, 0.0, [0.0]
+                for x_child in [2 * x, 2 * x + 1]:
+                    for y_child in [2 * y, 2 * y + 1]:
+                        _, _, count_child, mean_child, peak_one = pro.read_tile(root, "chunk", zoom + 1, x_child,
+                                                                                y_child)
+                        num, total = num + np.sum(count_child), total + np.sum(count_child * mean_child)
+                        peak_child.extend(peak_one.tolist())
+                self.assertEquals(num, np.sum(count))
+                self.assertTrue(np.isclose(total, np.sum(count * mean)))
+                self.assertTrue(np.isclose(max(peak_child), np.max(peak, initial=0.0)))
+
     def test_registry(self):
         registry = DlRegistry()
         model_object = MagNet()
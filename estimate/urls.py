@@ -16,12 +16,18 @@ urlpatterns = [
     re_path(r'^run$', RunView.as_view()),
     re_path(r'^conda$', CondaView.as_view()),
     re_path(r'^models$', ModelListView.as_view()),
+    re_path(r'^jobs$', JobListView.as_view()),
+    re_path(r'^jobs/(?P<pk>[0-9]+)$', JobView.as_view()),
+    re_path(r'^sweep$', SweepView.as_view()),
+    re_path(r'^predict/stats$', PredictStatsView.as_view()),
     re_path(r'^features$', FeatureListView.as_view()),
     re_path(r'^features/dist$', FeatureDistView.as_view()),
     re_path(r'^features/locate$', FeatureLocateView.as_view()),
+    re_path(r'^features/tile$', FeatureTileView.as_view()),
     re_path(r'models/([0-9]*)$', ModelOptView.as_view()),
     re_path(r'^(?P<model_name>.+)/train$', ModelTrainView.as_view()),
     re_path(r'^(?P<model_name>.+)/test$', ModelTestView.as_view()),
+    re_path(r'^(?P<model_name>.+)/predict$', ModelPredictView.as_view()),
     re_path(r'^(?P<model_name>.+)/detail$', ModelDetailView.as_view()),
     re_path(r'^(?P<model_name>.+)/process', ModelProcessView.as_view()),
     re_path(r'^(?P<model_name>.+)/(?P<opt>.+)/true_pred$', CompTruePredView.as_view()),
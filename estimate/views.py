@@ -4,17 +4,20 @@ from rest_framework import views, status, generics
 from rest_framework.response import Response
 from django.db import transaction
 from django.shortcuts import render
-import pandas as pd
 import numpy as np
 import subprocess
 import re
 import os
+import json
+import time
 import os.path as osp
 from .serializers import *
 from .models import *
-from func.process import ROOT, RE_AD, DEFAULT_MODELS, DEFAULT_LIBS, PY_AD, CONDA_AD
-from func.process import get_dist, get_lib_by_files, duplicate_lib, is_error
+from func.process import ROOT, RE_AD, DEFAULT_MODELS, DEFAULT_LIBS, PY_AD, CONDA_AD, LOCATE_NUM
+from func.process import get_dist, get_lib_by_files, duplicate_lib, is_error, read_meta_column, locate_source
+from func.process import read_tile, get_checkpoint_stats
 from func.net import cal_metrics
+from .jobs import SWEEP_PARAMS
 
 
 def get_model_by_pk(pk):
@@ -187,32 +190,18 @@ class ModelTrainView(views.APIView):
     def post(self, request, model_name):
         """
         Train model, from TrainParam.js
+        The training runs as a job in worker process, poll it by JobView
 
         :param request:
         :param model_name: Model name, like: MagInfoNet, EQGraphNet, MagNet,
-        :return: Train result, given by network.cal_metrics
+        :return: Job id, the train result given by network.cal_metrics is saved in the job
         """
         from web.wsgi import registry
-        model = DlModel.objects.filter(name=model_name)[0]
-
-        if model.situation == "testing":
-            return Response({"error": "Is testing"}, status=status.HTTP_409_CONFLICT)
-        model.situation = "training"
-        model.save()
-
-        # print("已注册的模型：\n{}\n".format(registry.models))
-        model_object = registry.models[model.id]
-        if model_name in DEFAULT_MODELS:
-            print("request.data: ", request.data)
-            result_train = model_object.training(request.data, model_name)
-        else:
-            result_train = ""
-            print("model_object: ", model_object)
-            print("result_train: ", result_train)
+        if model_name not in DEFAULT_MODELS:
             return Response(status=status.HTTP_400_BAD_REQUEST)
-        model.situation = "Free"
-        model.save()
-        return Response(result_train)
+        print("request.data: ", request.data)
+        job = registry.scheduler.submit(model_name, "train", request.data)
+        return Response({"job_id": job.pk}, status=status.HTTP_202_ACCEPTED)
 
 
 class ModelTestView(views.APIView):
@@ -229,28 +218,136 @@ class ModelTestView(views.APIView):
     def post(self, request, model_name):
         """
         Test model, from TestParam.js
+        The testing runs as a job in worker process, poll it by JobView
 
         :param request:
         :param model_name: Model name, like: MagInfoNet, EQGraphNet, MagNet,
-        :return: Test result, given by network.cal_metrics
+        :return: Job id, the test result given by network.cal_metrics is saved in the job
         """
         from web.wsgi import registry
-        model = DlModel.objects.filter(name=model_name)[0]
-        if model.situation == "training":
-            return Response({"error": "Is training"}, status=status.HTTP_409_CONFLICT)
-        model.situation = "testing"
-        model.save()
+        if model_name not in DEFAULT_MODELS:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        job = registry.scheduler.submit(model_name, "test", request.data)
+        return Response({"job_id": job.pk}, status=status.HTTP_202_ACCEPTED)
+
 
-        model_object = registry.models[model.id]
+class ModelPredictView(views.APIView):
+    def post(self, request, model_name):
+        """
+        Predict magnitudes of waveforms by a trained model, kept loaded in registry.pool
+        Concurrent requests of the same model are run in one batch by registry.batcher
+
+        :param request: JSON with 'waveforms' (num * 3 * 6000, or 3 * 6000), the params of ModelTestView
+                        (sm_scale, chunk_name, data_size, train_ratio), 'p_arrival_sample', 's_arrival_sample' and
+                        'p_travel_sec' for MagInfoNet, 'p_arrival_sample' for CREIME
+        :param model_name: Model name, like: MagInfoNet, EQGraphNet, MagNet,
+        :return: Predicted magnitudes
+        """
+        from web.wsgi import registry
+        if model_name not in DEFAULT_MODELS:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        params = {key: value for key, value in request.data.items() if key != 'waveforms'}
+        start = time.perf_counter()
         try:
-            result_test = model_object.testing(request.data, model_name)
-            model.situation = "Free"
-            model.save()
-            return Response(result_test)
+            magnitude = registry.batcher.predict(model_name, params, request.data['waveforms'], params)
         except FileNotFoundError:
-            model.situation = "Free"
-            model.save()
             return Response({"error": "File not found"}, status=status.HTTP_404_NOT_FOUND)
+        except (KeyError, ValueError) as e:
+            return Response({"error": "Invalid input: {}".format(e)}, status=status.HTTP_400_BAD_REQUEST)
+        cost = (time.perf_counter() - start) * 1000
+        return Response({"model_name": model_name, "magnitude": np.round(magnitude.astype(float), 4).tolist(),
+                         "cost_ms": round(cost, 2)})
+
+
+class PredictStatsView(views.APIView):
+    def get(self, request):
+        """
+        queue depth, batch size and latency of predictions, for tuning max_batch and max_wait_ms,
+        and hit/miss counts of checkpoint cache
+        """
+        from web.wsgi import registry
+        stats = registry.batcher.get_stats()
+        stats["checkpoint"] = get_checkpoint_stats()
+        return Response(stats)
+
+
+class JobListView(views.APIView):
+    def get(self, request):
+        """
+        show train/test jobs, of given model if 'name' is provided
+        """
+        job_list = DlJob.objects.all().order_by('-pk')
+        name = request.GET.get('name')
+        if name:
+            job_list = job_list.filter(name=name)
+        serializer = DlJobSerializer(job_list, many=True)
+        return Response(serializer.data)
+
+
+class JobView(views.APIView):
+    def get(self, request, pk):
+        """
+        get the situation, process and result of a train/test job
+        """
+        try:
+            job = DlJob.objects.get(pk=pk)
+        except DlJob.DoesNotExist:
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        serializer = DlJobSerializer(job)
+        return Response(serializer.data)
+
+    def delete(self, request, pk):
+        """
+        cancel a job which is still queued
+        """
+        if not DlJob.objects.filter(pk=pk, situation="queued").update(situation="canceled"):
+            return Response({"error": "Job is not queued"}, status=status.HTTP_409_CONFLICT)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class SweepView(views.APIView):
+    def post(self, request):
+        """
+        train models over a grid of params, every run is a job
+
+        :param request: JSON with 'model_names' (list), 'grid' (dict of param name and its values), and
+                        the shared params of ModelTrainView, like: device, epochs, chunk_name
+        :return: Sweep id and job ids
+        """
+        from web.wsgi import registry
+        names = request.data.get('model_names', [])
+        grid = request.data.get('grid', {})
+        if not names or any(name not in DEFAULT_MODELS for name in names):
+            return Response({"error": "Unknown model"}, status=status.HTTP_400_BAD_REQUEST)
+        if any((key not in SWEEP_PARAMS) or (not isinstance(value, list)) for key, value in grid.items()):
+            return Response({"error": "Grid params must be lists of: {}".format(", ".join(SWEEP_PARAMS))},
+                            status=status.HTTP_400_BAD_REQUEST)
+        params = {key: value for key, value in request.data.items() if key not in ['model_names', 'grid']}
+        try:
+            sweep, jobs = registry.scheduler.submit_sweep(names, params, grid)
+        except KeyError as e:
+            return Response({"error": "Missing param {}".format(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except FileNotFoundError as e:
+            return Response({"error": str(e)}, status=status.HTTP_404_NOT_FOUND)
+        return Response({"sweep": sweep, "job_ids": [job.pk for job in jobs]}, status=status.HTTP_202_ACCEPTED)
+
+    def get(self, request):
+        """
+        comparison table of the runs of a sweep, finished runs are sorted by rmse
+        """
+        job_list = DlJob.objects.filter(sweep=request.GET.get('sweep', '')).order_by('pk')
+        if not job_list.exists():
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        table = []
+        for job in job_list:
+            params = json.loads(job.params)
+            row = {"job_id": job.pk, "model_name": job.name, "situation": job.situation}
+            row.update({key: params.get(key) for key in SWEEP_PARAMS})
+            result = json.loads(job.result) if job.result else {}
+            row.update({key: result.get(key) for key in ['rmse', 'r2', 'e_mean', 'e_std']})
+            table.append(row)
+        table.sort(key=lambda row: float(row['rmse']) if row['rmse'] is not None else float('inf'))
+        return Response(table)
 
 
 class ModelListView(views.APIView):
@@ -319,7 +416,9 @@ class FeatureDistView(views.APIView):
         elif feature == "source_magnitude":
             v_min = 0
 
-        x, y = get_dist(feature, bins, chunk_name, data_size, v_min, v_max)
+        snr_style = request.GET.get('style', 'mean')
+
+        x, y = get_dist(feature, bins, chunk_name, data_size, v_min, v_max, snr_style)
 
         if feature in ["source_distance_km", "source_depth_km", "snr_db",
                        "p_arrival_sample", "s_arrival_sample"]:
@@ -342,24 +441,39 @@ class FeatureLocateView(views.APIView):
         lo_max = float(request.GET.get('lo_max'))
         la_min = float(request.GET.get('la_min'))
         la_max = float(request.GET.get('la_max'))
-        df = pd.read_csv(osp.join(ROOT, chunk_name, chunk_name + ".csv"))
-
-        la = df.loc[:, "source_latitude"].values.reshape(-1)
-        lo = df.loc[:, "source_longitude"].values.reshape(-1)
-        sm = df.loc[:, "source_magnitude"].values.reshape(-1)
-
-        idx = np.argwhere((la >= la_min) & (la <= la_max) & (lo >= lo_min) & (lo <= lo_max)).reshape(-1)
-        la, lo, sm = la[idx], lo[idx], sm[idx]
+        num = int(request.GET.get('num', LOCATE_NUM))
+        root = osp.join(ROOT, chunk_name)
 
-        num = 20000
-        idx_sample = np.random.choice(idx.shape[0], num, replace=False)
-        la, lo, sm = la[idx_sample], lo[idx_sample], sm[idx_sample]
+        idx = locate_source(root, chunk_name, la_min, la_max, lo_min, lo_max, num)
+        la = read_meta_column(root, chunk_name, "source_latitude")[idx]
+        lo = read_meta_column(root, chunk_name, "source_longitude")[idx]
+        sm = read_meta_column(root, chunk_name, "source_magnitude")[idx]
 
         sources = [{"Longitude": i, "Latitude": j, "Magnitude": k} for i, j, k in zip(lo, la, sm)]
         serializer = SourceSerializer(sources, many=True)
         return Response(serializer.data)
 
 
+class FeatureTileView(views.APIView):
+    def get(self, request):
+        """
+        get aggregated earthquake sources in a map tile (zoom, x, y), from LocateModal.js
+        """
+        chunk_name = request.GET.get('chunk_name')
+        zoom = int(request.GET.get('z'))
+        x = int(request.GET.get('x'))
+        y = int(request.GET.get('y'))
+        num = int(request.GET.get('num', LOCATE_NUM))
+        if (zoom < 0) | (x < 0) | (y < 0) | (x >= 2 ** zoom) | (y >= 2 ** zoom):
+            return Response({"error": "Tile out of range"}, status=status.HTTP_400_BAD_REQUEST)
+
+        lo, la, count, sm_mean, sm_max = read_tile(osp.join(ROOT, chunk_name), chunk_name, zoom, x, y, num)
+        tiles = [{"Longitude": i, "Latitude": j, "Count": k, "Magnitude": m, "MaxMagnitude": n}
+                 for i, j, k, m, n in zip(lo, la, count, sm_mean, sm_max)]
+        serializer = TileSerializer(tiles, many=True)
+        return Response(serializer.data)
+
+
 class ModelOptView(views.APIView):
     def put(self, request, pk):
         """
@@ -0,0 +1,107 @@
+"""
+Throughput benchmarks of the GNN paths in func.net, and of data loading in func.process
+
+python -m func.bench
+"""
+import time
+import torch
+from torch.utils.data import DataLoader
+import func.net as net
+import func.process as pro
+
+BATCH_SIZES = [16, 32, 64, 128, 256, 512]
+
+
+def cal_time(fun, repeat=3):
+    """
+    Best time (second) of running fun repeatedly, after one warm-up run
+    """
+    def sync():
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    with torch.no_grad():
+        fun()
+        cost = []
+        for _ in range(repeat):
+            sync()
+            start = time.perf_counter()
+            fun()
+            sync()
+            cost.append(time.perf_counter() - start)
+    return min(cost)
+
+
+def bench_unimp(batch_sizes=None, num_nodes=600, in_dim=32, out_dim=32, repeat=3, device="cpu"):
+    """
+    Compare batched "unimp" in run_gnn against running TransformerConv sample by sample (MagInfoNet.gnn1)
+
+    :return: List of (batch_size, time of loop, time of batched)
+    """
+    if batch_sizes is None:
+        batch_sizes = BATCH_SIZES
+    torch.manual_seed(0)
+    gnn = net.get_gnn("unimp", in_dim, out_dim).to(device)
+    ei, ew = net.get_edge_info(1, num_nodes, "ts_un", device)
+    result = []
+    for batch_size in batch_sizes:
+        x = torch.randn(batch_size, num_nodes, in_dim, device=device)
+        t_loop = cal_time(lambda: net.run_gnn_each(gnn, x, ei), repeat)
+        t_batch = cal_time(lambda: net.run_gnn("unimp", gnn, x, ei, ew), repeat)
+        print("unimp  batch_size: {:4d}  loop: {:.4f}s  batched: {:.4f}s  speedup: {:.1f}x".
+              format(batch_size, t_loop, t_batch, t_loop / t_batch))
+        result.append((batch_size, t_loop, t_batch))
+    return result
+
+
+def bench_banded(batch_sizes=None, repeat=3, device="cpu"):
+    """
+    Compare EQGraphNet with "banded" against "gcn" (GCNConv), the same weights are used
+
+    :return: List of (batch_size, time of gcn, time of banded)
+    """
+    if batch_sizes is None:
+        batch_sizes = BATCH_SIZES
+    torch.manual_seed(0)
+    model_gcn = net.EQGraphNet("gcn", "ts_un", 1, device).to(device)
+    model_banded = net.EQGraphNet("banded", "ts_un", 1, device).to(device)
+    model_banded.load_state_dict(model_gcn.state_dict())
+    result = []
+    for batch_size in batch_sizes:
+        x = torch.randn(batch_size, 3, 6000, device=device)
+        t_gcn = cal_time(lambda: model_gcn(x), repeat)
+        t_banded = cal_time(lambda: model_banded(x), repeat)
+        print("EQGraphNet  batch_size: {:4d}  gcn: {:.4f}s  banded: {:.4f}s  speedup: {:.1f}x".
+              format(batch_size, t_gcn, t_banded, t_gcn / t_banded))
+        result.append((batch_size, t_gcn, t_banded))
+    return result
+
+
+def bench_loader(num=2048, batch_size=64, prefetch=pro.PREFETCH):
+    """
+    Items/sec of one epoch over SelfData, DataLoader (per-item __getitem__ and collate) against BatchLoader
+
+    :return: Dict of loader name and items/sec
+    """
+    torch.manual_seed(0)
+    dataset = pro.SelfData(torch.randn(num, 3, 6000), torch.rand(num), torch.rand(num, 2), torch.rand(num, 1))
+    loaders = {
+        "DataLoader": DataLoader(dataset, batch_size=batch_size, shuffle=True),
+        "BatchLoader": pro.BatchLoader(dataset, batch_size, prefetch=0),
+        "BatchLoader(prefetch={})".format(prefetch): pro.BatchLoader(dataset, batch_size, prefetch=prefetch),
+    }
+    result = {}
+    for name, loader in loaders.items():
+        start = time.perf_counter()
+        for _ in loader:
+            pass
+        result[name] = num / (time.perf_counter() - start)
+        print("{:26s} items/sec: {:.0f}".format(name, result[name]))
+    return result
+
+
+if __name__ == "__main__":
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    bench_unimp(device=device)
+    bench_banded(device=device)
+    bench_loader()
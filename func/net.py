@@ -1,5 +1,6 @@
 import numpy as np
 import torch
+from functools import lru_cache
 import torch.nn as nn
 import torch_geometric.nn as gnn
 
@@ -272,15 +273,27 @@ class MagInfoNet(nn.Module):
 
 
 def get_edge_info(k, num_nodes, adm_style, device):
+    edge_index, edge_weight = get_edge(k, num_nodes, adm_style)
+    edge_index = edge_index.to(device)
+    # edge_index is shared by layers and models, edge_weight is learned by each layer
+    return edge_index, nn.Parameter(edge_weight.clone())
+
+
+@lru_cache(maxsize=None)
+def get_edge(k, num_nodes, adm_style):
+    """
+    edge_index and edge_weight of graph, the same as tran_adm_to_edge_index(ts_un(num_nodes, k)) or
+    tran_adm_to_edge_index(tg(num_nodes)), without building the dense adjacency matrix
+    """
     if adm_style == "ts_un":
-        adm = ts_un(num_nodes, k)
+        u, v = ts_un_edge(num_nodes, k)
     elif adm_style == "tg":
-        adm = tg(num_nodes)
+        u, v = tg_edge(num_nodes)
     else:
         raise TypeError("Unknown type of adm_style!")
-    edge_index, edge_weight = tran_adm_to_edge_index(adm)
-    edge_index = edge_index.to(device)
-    return edge_index, nn.Parameter(edge_weight)
+    edge_index = torch.from_numpy(np.vstack([u, v])).long()
+    edge_weight = torch.full((u.shape[0],), 0.5)
+    return edge_index, edge_weight
 
 
 def get_gnn(gnn_style, in_dim, out_dim):
@@ -304,29 +317,92 @@ def get_gnn(gnn_style, in_dim, out_dim):
         return gnn.CGConv(in_dim)
     elif gnn_style == "unimp":
         return gnn.TransformerConv(in_dim, out_dim)
+    elif gnn_style == "banded":
+        return BandedGCN(in_dim, out_dim)
     else:
         raise TypeError("Unknown type of gnn_style!")
 
 
+class BandedGCN(nn.Module):
+    """
+    GCNConv for graphs whose edges link nodes at a few fixed distances, like ts_un and tg
+
+    The normalized aggregation is done by shifting the whole node axis once for each distance,
+    instead of gathering and scattering every edge. Parameters have the same names as GCNConv,
+    so the model weights of "gcn" and "banded" can be loaded by each other
+    """
+    def __init__(self, in_dim, out_dim):
+        super(BandedGCN, self).__init__()
+        self.lin = nn.Linear(in_dim, out_dim, bias=False)
+        self.bias = nn.Parameter(torch.zeros(out_dim))
+        nn.init.xavier_uniform_(self.lin.weight)
+        self.band = None
+
+    def get_band(self, edge_index):
+        """
+        Distances (source - target) of edges, and the position of each edge in the (num_shift, num_nodes) band
+        """
+        if self.band is None or self.band[0] is not edge_index:
+            shift = edge_index[0] - edge_index[1]
+            shifts, idx_shift = torch.unique(shift, return_inverse=True)
+            self.band = (edge_index, shifts.tolist(), idx_shift)
+        return self.band[1], self.band[2]
+
+    def forward(self, x, edge_index, edge_weight):
+        """
+        :param x: Node features, shape (batch_size, in_dim, num_nodes)
+        :return: shape (batch_size, out_dim, num_nodes)
+        """
+        num_nodes = x.shape[-1]
+        shifts, idx_shift = self.get_band(edge_index)
+        weight = edge_weight.new_zeros(len(shifts), num_nodes)
+        weight = weight.index_put((idx_shift, edge_index[1]), edge_weight, accumulate=True)
+
+        # symmetric normalization of gcn_norm, with self-loops of weight 1
+        deg_inv_sqrt = (weight.sum(dim=0) + 1).pow(-0.5)
+        deg_inv_sqrt = deg_inv_sqrt.masked_fill(torch.isinf(deg_inv_sqrt), 0)
+
+        h = torch.matmul(self.lin.weight, x)
+        h_src = h * deg_inv_sqrt
+        out = h_src
+        for i, shift in enumerate(shifts):
+            out = out + weight[i] * torch.roll(h_src, -shift, dims=-1)
+        out = out * deg_inv_sqrt
+        return out + self.bias.view(-1, 1)
+
+
 def run_gnn(gnn_style, gnn, x, ei, ew):
     if gnn_style in ["gcn", "cheb", "sg", "appnp"]:
         return gnn(x.permute(0, 2, 1), ei, ew).permute(0, 2, 1)
+    elif gnn_style in ["banded"]:
+        return gnn(x, ei, ew)
     elif gnn_style in ["unimp"]:
-        batch_size = x.shape[0]  # 批量数量
-        h_all = None
-        for i in range(batch_size):  # 将每个样本输入图神经网络后，将每个输出结果拼接
-            x_one = x[i, :, :]
-            h = gnn(x_one, ei)
-            h = h.unsqueeze(0)
-            if h_all is None:
-                h_all = h
-            else:
-                h_all = torch.cat((h_all, h), dim=0)
-        return h_all
+        # 将批量中的样本拼成一个不相连的大图，一次输入图神经网络
+        batch_size, num_nodes = x.shape[0], x.shape[1]
+        h = gnn(x.reshape(batch_size * num_nodes, -1), batch_edge_index(ei, batch_size, num_nodes))
+        return h.view(batch_size, num_nodes, -1)
     else:
         return gnn(x.permute(0, 2, 1), ei).permute(0, 2, 1)
 
 
+def run_gnn_each(gnn, x, ei):
+    """
+    Run the GNN sample by sample, the reference of batched "unimp" in run_gnn
+    """
+    return torch.stack([gnn(x[i, :, :], ei) for i in range(x.shape[0])], dim=0)
+
+
+def batch_edge_index(ei, batch_size, num_nodes):
+    """
+    Tile edge_index of one graph for a batch of graphs, the nodes of i-th graph are offset by i * num_nodes
+
+    :param ei: edge_index of one graph, shape (2, num_edges)
+    :return: edge_index of the disjoint block graph, shape (2, batch_size * num_edges)
+    """
+    offset = torch.arange(batch_size, device=ei.device).view(-1, 1, 1) * num_nodes
+    return (ei.unsqueeze(0) + offset).permute(1, 0, 2).reshape(2, -1)
+
+
 def ts_un(n, k):
     adm = np.zeros(shape=(n, n))
     if k < 1:
@@ -347,6 +423,28 @@ def ts_un(n, k):
     return adm
 
 
+def ts_un_edge(n, k):
+    """
+    Edges of ts_un(n, k), each node i is linked to i-k, ..., i-1, i+1, ..., i+k, in the row-major order of np.nonzero
+    """
+    if k < 1:
+        raise ValueError("k must be greater than or equal to 1")
+    shift = np.concatenate([np.arange(-k, 0), np.arange(1, k + 1)])
+    u = np.repeat(np.arange(n), shift.shape[0])
+    v = u + np.tile(shift, n)
+    remain = (v >= 0) & (v < n)
+    return u[remain], v[remain]
+
+
+def tg_edge(m):
+    """
+    Edges of tg(m), each node i is linked to i-1, and node 0 is linked to m-1
+    """
+    u = np.arange(m)
+    v = np.where(u == 0, m - 1, u - 1)
+    return u, v
+
+
 def tg(m):
     adm = np.zeros(shape=(m, m))
     for i in range(m - 1):
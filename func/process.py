@@ -6,6 +6,14 @@ import numpy as np
 import os
 import os.path as osp
 import inspect
+import json
+import time
+import fcntl
+import threading
+import queue
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
 from torch.utils.data import Dataset
 from sklearn.preprocessing import StandardScaler
 
@@ -101,15 +109,67 @@ def duplicate_lib(string):
     return "\n".join(list(dict.fromkeys(code)))
 
 
-def get_train_or_test_idx(num, num_train):
-    idx_all = np.arange(num)
-    idx_train = np.random.choice(num, num_train, replace=False)
-    idx_test = np.array(list(set(idx_all) - set(idx_train)))
-    return idx_train, idx_test
+SPLIT_SEED = 100
+
+
+def get_train_or_test_idx(num, num_train, seed=SPLIT_SEED):
+    """
+    Random Training set, and the rest (sorted) as Testing set, without touching the global random state
+    Training set is the same as np.random.seed(seed) then np.random.choice(num, num_train, replace=False)
+    """
+    idx_train = np.random.RandomState(seed).permutation(num)[:num_train]
+    mask = np.ones(num, dtype=bool)
+    mask[idx_train] = False
+    return idx_train, np.flatnonzero(mask)
+
+
+def save_replace(path, save, *args, mode='wb', **kwargs):
+    """
+    Save by save(file, *args, **kwargs) (np.save, np.savez) into a temporary file, then rename it to path
+    Readers of path, also memory-mapped ones, see the old file or the whole new one, never a half-written one
+    mode='w' for text files, see save_json
+    """
+    tmp_ad = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_ad, mode) as f:
+        save(f, *args, **kwargs)
+    os.replace(tmp_ad, path)
+    return None
+
+
+def save_json(path, obj):
+    """
+    Save obj as json by save_replace
+    """
+    return save_replace(path, lambda f: json.dump(obj, f), mode='w')
+
+
+def load_split(root, data_size, num_train):
+    """
+    Training and Testing index of a sample, computed once and saved as 'split_<num_train>.npy' (int32,
+    Training index followed by Testing index) next to 'index.pt', or as 'split_<data_size>_<num_train>.npy' in
+    the sample store, and memory-mapped afterwards
+
+    :param root: Directory of the chunk
+    :param data_size: Size of the sample
+    :param num_train: Size of Training set
+    :return: idx_train, idx_test
+    """
+    if is_legacy_sample(root, data_size):
+        split_ad = osp.join(root, str(data_size), "split_{}.npy".format(num_train))
+    else:
+        split_ad = osp.join(get_store_ad(root), "split_{}_{}.npy".format(data_size, num_train))
+    if not osp.exists(split_ad):
+        idx_train, idx_test = get_train_or_test_idx(data_size, num_train)
+        if not osp.isdir(osp.dirname(split_ad)):
+            return idx_train, idx_test
+        # workers may create the same split at the same time
+        save_replace(split_ad, np.save, np.concatenate([idx_train, idx_test]).astype(np.int32))
+    split = np.load(split_ad, mmap_mode='r')
+    return split[:num_train], split[num_train:]
 
 
 def be_tensor(x):
-    if type(x) == np.ndarray:
+    if isinstance(x, np.ndarray):
         return torch.from_numpy(x)
     elif torch.is_tensor(x):
         return x
@@ -120,7 +180,7 @@ def be_tensor(x):
 def get_item_by_dim(data, item):
     if torch.is_tensor(data):
         n_dim = data.dim()
-    elif type(data) == np.ndarray:
+    elif isinstance(data, np.ndarray):
         n_dim = data.ndim
     else:
         raise TypeError("The input must be torch.tensor or numpy.ndarray!")
@@ -137,9 +197,12 @@ def get_item_by_dim(data, item):
 
 
 class SelfData(Dataset):
-    def __init__(self, data, label, *args):
+    def __init__(self, data, label, *args, rows=None):
         super(SelfData, self).__init__()
-        self.data = be_tensor(data)
+        # memory-mapped waveforms stay on disk, rows are paged in by __getitem__
+        self.data = data if isinstance(data, np.memmap) else be_tensor(data)
+        # item i is row rows[i] of data, so a subset is taken without copying it
+        self.rows = None if rows is None else be_numpy(rows)
         self.label = be_tensor(label)
         self.args = args
         self.data_else = self.get_data_else()
@@ -154,10 +217,15 @@ class SelfData(Dataset):
         return data_else
 
     def __len__(self):
+        if self.rows is not None:
+            return self.rows.shape[0]
         return self.data.shape[0]
 
+    def get_rows(self, idx):
+        return idx if self.rows is None else self.rows[idx]
+
     def __getitem__(self, item):
-        data_one = get_item_by_dim(self.data, item)
+        data_one = be_tensor(get_item_by_dim(self.data, self.get_rows(item)))
         label_one = get_item_by_dim(self.label, item)
         result = [data_one, label_one]
         if len(self.data_else) != 0:
@@ -171,8 +239,341 @@ class SelfData(Dataset):
         result.append(item)
         return tuple(result)
 
+    def get_batch(self, idx):
+        """
+        A whole batch by fancy indexing, the same as collating __getitem__ of every item in idx
 
-def remain_sm_scale(data, df, label, scale):
+        :param idx: ndarray of items
+        """
+        idx_t = torch.from_numpy(idx)
+        rows = self.get_rows(idx)
+        if isinstance(self.data, np.memmap):
+            data = torch.from_numpy(np.ascontiguousarray(self.data[rows]))
+        else:
+            data = self.data[torch.from_numpy(rows)]
+        result = [data, self.label[idx_t]] + [be_tensor(x)[idx_t] for x in self.data_else]
+        result.append(idx_t)
+        return tuple(result)
+
+
+PREFETCH = 2
+
+
+def get_prefetch():
+    """
+    Default prefetch of BatchLoader, PREFETCH if this process has more than one core for torch, else 0,
+    as the prefetching thread would only compete with the training loop for the GIL on one core
+    """
+    return PREFETCH if torch.get_num_threads() > 1 else 0
+
+
+class BatchLoader:
+    """
+    Batches of SelfData, taken by blocks of shuffled index, instead of per-item __getitem__ and collate
+
+    With prefetch > 0, a thread prepares up to prefetch batches ahead of the training loop, default get_prefetch().
+    pin_memory pins the batches, for non-blocking copy to gpu
+    """
+
+    def __init__(self, dataset, batch_size, shuffle=True, prefetch=None, pin_memory=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.prefetch = get_prefetch() if prefetch is None else prefetch
+        self.pin_memory = pin_memory
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def get_batches(self):
+        num = len(self.dataset)
+        order = torch.randperm(num).numpy() if self.shuffle else np.arange(num)
+        for start in range(0, num, self.batch_size):
+            batch = self.dataset.get_batch(order[start:start + self.batch_size])
+            if self.pin_memory:
+                batch = tuple(x.pin_memory() for x in batch)
+            yield batch
+
+    def __iter__(self):
+        if self.prefetch <= 0:
+            yield from self.get_batches()
+            return
+        batches, stop = queue.Queue(maxsize=self.prefetch), threading.Event()
+
+        def put(x):
+            # give up when the loop is left early
+            while not stop.is_set():
+                try:
+                    batches.put(x, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def work():
+            try:
+                for batch in self.get_batches():
+                    if not put(batch):
+                        return
+                put(None)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=work, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+
+
+def create_sample(save_ad, shape, name="data.npy"):
+    """
+    Create an empty waveform store 'data.npy' (float32), filled row by row without holding it in memory
+
+    :param save_ad: Directory of the sample, like root/<data_size>
+    :param shape: (data_size, 3, 6000)
+    :param name: File name of the store, a temporary name if it is renamed to 'data.npy' after filled
+    :return: numpy.memmap, opened in write mode
+    """
+    if not osp.exists(save_ad):
+        os.makedirs(save_ad)
+    return np.lib.format.open_memmap(osp.join(save_ad, name), mode='w+', dtype=np.float32, shape=shape)
+
+
+def is_legacy_sample(root, data_size):
+    """
+    Whether the sample is saved on its own, as root/<data_size>/data.npy (or data.pt) and index.pt
+    """
+    save_ad = osp.join(root, str(data_size))
+    return osp.exists(osp.join(save_ad, "index.pt")) and (osp.exists(osp.join(save_ad, "data.npy")) or
+                                                         osp.exists(osp.join(save_ad, "data.pt")))
+
+
+def load_sample(root, data_size):
+    """
+    Load the waveforms of a sample and their rows in chunk.csv (sidecar 'index.pt')
+    The waveforms are memory-mapped, so only the rows being indexed are read from disk
+    Without a sample of its own, the sample is the first data_size traces of the sample store, see grow_store
+
+    :param root: Directory of the chunk
+    :param data_size: Size of the sample
+    :return: data (numpy.memmap, float32), index (ndarray)
+    """
+    if not is_legacy_sample(root, data_size):
+        return load_store(root, data_size)
+    save_ad = osp.join(root, str(data_size))
+    data_ad, index_ad = osp.join(save_ad, "data.npy"), osp.join(save_ad, "index.pt")
+    pt_ad = osp.join(save_ad, "data.pt")
+    if not osp.exists(data_ad) and osp.exists(pt_ad):
+        # convert the monolithic 'data.pt' once, it is not read again
+        # written aside and renamed, so other workers never map a half-written 'data.npy'
+        tmp_name = "data.npy.{}.tmp".format(os.getpid())
+        data_pt = torch.load(pt_ad)
+        data = create_sample(save_ad, tuple(data_pt.shape), tmp_name)
+        data[:] = data_pt.float().numpy()
+        data.flush()
+        del data, data_pt
+        os.replace(osp.join(save_ad, tmp_name), data_ad)
+    data = np.load(data_ad, mmap_mode='c')
+    index = be_numpy(torch.load(index_ad))
+    return data, index
+
+
+STORE_NAME = "sample"
+TRACE_SHAPE = (3, 6000)
+
+
+def get_store_ad(root):
+    return osp.join(root, STORE_NAME)
+
+
+def read_store(root):
+    """
+    Information of the sample store of a chunk (store.json), None if there is no store
+    """
+    info_ad = osp.join(get_store_ad(root), "store.json")
+    if not osp.exists(info_ad):
+        return None
+    with open(info_ad, 'r') as f:
+        return json.load(f)
+
+
+def open_store(data_ad, mode, num=None):
+    """
+    Memory-map a waveform store, 'data.npy' of a sample or raw 'data.f32' of the sample store
+
+    :param num: Number of traces mapped from raw store, all traces in file if not given
+    """
+    if data_ad.endswith(".npy"):
+        return np.load(data_ad, mmap_mode=mode)
+    if num is None:
+        num = osp.getsize(data_ad) // (np.dtype(np.float32).itemsize * int(np.prod(TRACE_SHAPE)))
+    return np.memmap(data_ad, dtype=np.float32, mode=mode, shape=(num,) + TRACE_SHAPE)
+
+
+def grow_store(root, chunk_name, data_size, num_workers=None):
+    """
+    Grow the sample store of a chunk (root/sample) to at least data_size traces
+
+    Traces are stored in the order of a fixed random permutation of chunk.csv ('perm.npy'), appended to a raw
+    float32 file 'data.f32', so a sample of any size is a prefix of the store, and only the missing traces are
+    extracted from hdf5. 'store.json' records the number of complete traces, and the stamp of chunk.csv which
+    the store is built from, the store is built again when chunk.csv changes.
+    Processes growing the same store take turns, by an exclusive lock on 'store.lock'
+
+    :param root: Directory of the chunk
+    :param chunk_name: like "chunk2"
+    :param data_size: Size of the sample
+    :param num_workers: Number of worker processes of extract_waveform
+    :return: Number of traces in store
+    """
+    store_ad = get_store_ad(root)
+    perm_ad, data_ad = osp.join(store_ad, "perm.npy"), osp.join(store_ad, "data.f32")
+    trace_name = read_meta_column(root, chunk_name, "trace_name")
+    stamp = get_meta(root, chunk_name)["stamp"]
+    num = trace_name.shape[0]
+    if data_size > num:
+        raise ValueError("data_size {} is larger than chunk {} ({})".format(data_size, chunk_name, num))
+    if not osp.exists(store_ad):
+        os.makedirs(store_ad)
+    with open(osp.join(store_ad, "store.lock"), 'a') as lock:
+        # released when the lock file is closed
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        info = read_store(root)
+        if info is not None and info.get("stamp") != stamp:
+            # rows of the old chunk.csv, unlinked so that processes mapping them keep the old files
+            for file in os.listdir(store_ad):
+                if file == "data.f32" or (file.startswith("split_") and not file.endswith(".tmp")):
+                    os.remove(osp.join(store_ad, file))
+            info = None
+        if info is None:
+            save_replace(perm_ad, np.save, np.random.RandomState(SPLIT_SEED).permutation(num).astype(np.int32))
+        count = 0 if info is None else info["count"]
+        if count >= data_size:
+            return count
+
+        # traces after count may be left by an interrupted growth, they are extracted again.
+        # The file is never shortened, processes may be mapping its traces
+        size = data_size * np.dtype(np.float32).itemsize * int(np.prod(TRACE_SHAPE))
+        with open(data_ad, 'ab') as f:
+            if os.fstat(f.fileno()).st_size < size:
+                f.truncate(size)
+        perm = np.load(perm_ad, mmap_mode='r')
+        extract_waveform(osp.join(root, chunk_name + ".hdf5"), trace_name[perm[count:data_size]], data_ad,
+                         num_workers, start=count)
+
+        save_json(osp.join(store_ad, "store.json"),
+                  {"count": data_size, "chunk_name": chunk_name, "chunk_size": num, "stamp": stamp})
+    return data_size
+
+
+def load_store(root, data_size):
+    """
+    The first data_size traces of the sample store and their rows in chunk.csv
+
+    :return: data (numpy.memmap, float32), index (ndarray)
+    """
+    info = read_store(root)
+    if info is None or info["count"] < data_size:
+        raise FileNotFoundError("No sample of size {} in {}".format(data_size, root))
+    if info.get("stamp") != get_meta(root, info["chunk_name"])["stamp"]:
+        # perm would pair the waveforms with rows of the new chunk.csv
+        raise FileNotFoundError("Sample store of {} is built from an old {}.csv".format(root, info["chunk_name"]))
+    store_ad = get_store_ad(root)
+    data = open_store(osp.join(store_ad, "data.f32"), 'c', info["count"])[:data_size]
+    index = np.load(osp.join(store_ad, "perm.npy"), mmap_mode='r')[:data_size]
+    return data, index
+
+
+def get_offset(hdf5_ad, names):
+    """
+    Get the storage offsets of traces in hdf5 file, -1 for chunked datasets which have no single offset
+    """
+    with h5py.File(hdf5_ad, 'r') as f:
+        group = f['data']
+        offset = [group[name].id.get_offset() for name in names]
+    return np.array([-1 if one is None else one for one in offset], dtype=np.int64)
+
+
+_EXTRACT = {}
+
+
+def init_extract(hdf5_ad, data_ad):
+    """
+    Open one hdf5 handle and the output store in each worker process
+    """
+    _EXTRACT['group'] = h5py.File(hdf5_ad, 'r')['data']
+    _EXTRACT['data'] = open_store(data_ad, 'r+')
+    return None
+
+
+def extract_batch(batch):
+    """
+    Read a batch of traces (in storage order) and write them into their rows of the output store
+    """
+    rows, names = batch
+    group, data = _EXTRACT['group'], _EXTRACT['data']
+    buf = None
+    for row, name in zip(rows, names):
+        dataset = group[name]
+        if buf is None or buf.shape != dataset.shape:
+            buf = np.empty(dataset.shape, dtype=np.float32)
+        dataset.read_direct(buf)
+        data[row, :, :] = buf.T
+    data.flush()
+    return len(rows)
+
+
+def extract_waveform(hdf5_ad, names, data_ad, num_workers=None, batch_size=256, start=0):
+    """
+    Extract traces from STEAD hdf5 file into a preallocated store, i.e., data[start + c] = trace of names[c]
+    Traces are sorted by storage offset and read in batches, by a pool of worker processes
+
+    :param hdf5_ad: Address of chunk.hdf5
+    :param names: Trace names, ndarray of str
+    :param data_ad: Address of store created by create_sample, or of the sample store
+    :param num_workers: Number of worker processes, default os.cpu_count()
+    :param batch_size: Number of traces read by a worker at a time
+    :param start: Row of the first trace in store
+    :return: Number of extracted traces
+    """
+    names = np.asarray(names).astype(str)
+    num = names.shape[0]
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    order = np.argsort(get_offset(hdf5_ad, names), kind='stable')
+    batches = [(start + order[i: i + batch_size], names[order[i: i + batch_size]]) for i in range(0, num, batch_size)]
+
+    t0 = time.time()
+    with tqdm(total=num, unit="trace") as bar:
+        if num_workers <= 1:
+            init_extract(hdf5_ad, data_ad)
+            for batch in batches:
+                bar.update(extract_batch(batch))
+            _EXTRACT.clear()
+        else:
+            with ProcessPoolExecutor(num_workers, initializer=init_extract, initargs=(hdf5_ad, data_ad)) as pool:
+                for num_one in pool.map(extract_batch, batches):
+                    bar.update(num_one)
+    cost = max(time.time() - t0, 1e-6)
+    print("Extract {} traces in {:.1f}s, {:.1f} traces/s, {:.1f} MB/s".
+          format(num, cost, num / cost, num * 3 * 6000 * 4 / cost / 2 ** 20))
+    return num
+
+
+def get_sm_scale_idx(df, scale):
+    """
+    Rows of df whose source_magnitude_type is scale (str) or in scale (list)
+
+    :return: idx_sm (ndarray), scale_name (str)
+    """
     if isinstance(scale, list):
         smt = df['source_magnitude_type'].isin(scale).values
         idx_sm = np.argwhere(smt).reshape(-1)
@@ -187,6 +588,11 @@ def remain_sm_scale(data, df, label, scale):
         smt = df.source_magnitude_type.values.reshape(-1)
         idx_sm = np.argwhere(smt == scale).reshape(-1)
         scale_name = scale
+    return idx_sm, scale_name
+
+
+def remain_sm_scale(data, df, label, scale):
+    idx_sm, scale_name = get_sm_scale_idx(df, scale)
     data = data[idx_sm, :, :]
     label = label[idx_sm]
     df = df.iloc[idx_sm, :]
@@ -210,6 +616,27 @@ def prep_pt(prep_style, train, test=None):
     return model, train_prep, test_prep
 
 
+def cal_norm(values):
+    """
+    Mean and std of columns, the same statistics as StandardScaler of prep_pt
+
+    :param values: ndarray, shape (num, num_feature)
+    :return: mean, std (float32), std of constant column is 1
+    """
+    values = np.asarray(values, dtype=np.float64).reshape(values.shape[0], -1)
+    mean, std = np.nanmean(values, axis=0), np.nanstd(values, axis=0)
+    std[std == 0] = 1
+    return mean.astype(np.float32), std.astype(np.float32)
+
+
+def apply_norm(values, mean, std):
+    """
+    Standardize columns by saved statistics, as float32 tensor
+    """
+    values = torch.as_tensor(np.asarray(values, dtype=np.float32).reshape(-1, mean.shape[0]))
+    return (values - torch.from_numpy(mean)) / torch.from_numpy(std)
+
+
 def save_result(style, re_ad, true, pred, loss, sm_scale, name, m_train, m_test, model=None):
     if not osp.exists(re_ad):
         os.makedirs(re_ad)
@@ -223,66 +650,449 @@ def save_result(style, re_ad, true, pred, loss, sm_scale, name, m_train, m_test,
     return True
 
 
-def read_snr(df, style):
-    snr = df.snr_db.values
-    num = snr.shape[0]
-    snr_all = []
-    for i in range(num):
-        snr_one = snr[i][1:-1]
-        snr_one_ = snr_one.split(' ')
-        num_full = snr_one_.count('')
-        idx = 0
-        while idx < num_full:
-            snr_one_.remove('')
-            idx = idx + 1
-        snr_one_ = np.array([float(snr_one_[0]), float(snr_one_[1]), float(snr_one_[2])])
-        if style == "mean":
-            snr_one_mean = np.mean(snr_one_)
-            snr_all.append(snr_one_mean)
+CKPT_MB = 512
+_CKPT = {"cache": OrderedDict(), "bytes": 0, "hit": 0, "miss": 0, "lock": threading.Lock()}
+
+
+def load_checkpoint(path):
+    """
+    torch.load of model checkpoint, cached in this process by (path, mtime, size)
+
+    Deserialized state dicts are kept under CKPT_MB, the least recently used ones are evicted.
+    load_state_dict copies the tensors into model, so the cached state dict is never modified
+
+    :param path: File of checkpoint, like: model_{sm_scale}_{chunk}_{train}_{test}.pkl
+    :return: state dict
+    """
+    stat = os.stat(path)
+    key = (osp.abspath(path), stat.st_mtime_ns, stat.st_size)
+    cache = _CKPT["cache"]
+    with _CKPT["lock"]:
+        if key in cache:
+            cache.move_to_end(key)
+            _CKPT["hit"] += 1
+            return cache[key][0]
+        _CKPT["miss"] += 1
+    state_dict = torch.load(path, map_location="cpu")
+    size = sum(one.numel() * one.element_size() for one in state_dict.values() if torch.is_tensor(one))
+    with _CKPT["lock"]:
+        # the older versions of the same file are not used again
+        for old in [one for one in cache if one[0] == key[0]]:
+            _CKPT["bytes"] -= cache.pop(old)[1]
+        cache[key] = (state_dict, size)
+        _CKPT["bytes"] += size
+        while _CKPT["bytes"] > CKPT_MB * 1024 * 1024 and len(cache) > 1:
+            _CKPT["bytes"] -= cache.popitem(last=False)[1][1]
+    return state_dict
+
+
+def get_checkpoint_stats():
+    """
+    Hit and miss counts of load_checkpoint, and the cached checkpoints
+    """
+    with _CKPT["lock"]:
+        return {"hit": _CKPT["hit"], "miss": _CKPT["miss"], "num": len(_CKPT["cache"]),
+                "mb": round(_CKPT["bytes"] / 1024 / 1024, 2), "budget_mb": CKPT_MB}
+
+
+META_FLOAT = ["receiver_latitude", "receiver_longitude", "receiver_elevation_m", "p_arrival_sample", "p_weight",
+              "p_travel_sec", "s_arrival_sample", "s_weight", "source_origin_uncertainty_sec", "source_latitude",
+              "source_longitude", "source_error_sec", "source_gap_deg", "source_horizontal_uncertainty_km",
+              "source_depth_km", "source_depth_uncertainty_km", "source_magnitude", "source_distance_deg",
+              "source_distance_km", "back_azimuth_deg"]
+META_VERSION = 1
+GRID_DEG = 1.0
+LOCATE_NUM = 20000
+TILE_CELLS = 16
+TILE_ZOOM = 6
+_META = {}
+
+
+def build_meta(root, chunk_name):
+    """
+    Convert chunk.csv into typed columns, saved as root/<chunk_name>_meta/<column>.npy
+    Columns in META_FLOAT are float64 ("None" becomes nan), the others keep numeric dtype or become str
+    snr_db is also parsed into (N, 3) float32, saved as snr_db_value.npy
+
+    :param root: Directory of the chunk
+    :param chunk_name: like "chunk2"
+    :return: Information of the columns, saved as meta.json
+    """
+    csv_ad = osp.join(root, chunk_name + ".csv")
+    meta_ad = osp.join(root, chunk_name + "_meta")
+    if not osp.exists(meta_ad):
+        os.makedirs(meta_ad)
+    for file in os.listdir(meta_ad):
+        if file.startswith(("hist_", "grid_", "tile_")) and not file.endswith(".tmp"):    # indexes of the old csv
+            try:
+                os.remove(osp.join(meta_ad, file))
+            except FileNotFoundError:
+                pass            # removed by another process rebuilding at the same time
+    stat = os.stat(csv_ad)
+    df = pd.read_csv(csv_ad, low_memory=False)
+    for column in df.columns:
+        values = df[column]
+        if column in META_FLOAT:
+            values = pd.to_numeric(values, errors='coerce').to_numpy(dtype=np.float64)
+        elif pd.api.types.is_numeric_dtype(values):
+            values = values.to_numpy()
         else:
-            raise TypeError("Unknown type of style")
-    snr_all = np.array(snr_all)
-    return snr_all
+            values = np.asarray(values, dtype=str)
+        save_replace(osp.join(meta_ad, column + ".npy"), np.save, values)
+    derived = []
+    if "snr_db" in df.columns:
+        save_replace(osp.join(meta_ad, "snr_db_value.npy"), np.save, parse_snr(df["snr_db"]))
+        derived.append("snr_db_value")
+    info = {"version": META_VERSION, "stamp": [stat.st_mtime_ns, stat.st_size],
+            "columns": df.columns.tolist(), "derived": derived}
+    # published after all columns are in place
+    save_json(osp.join(meta_ad, "meta.json"), info)
+    return info
+
+
+def get_meta(root, chunk_name):
+    """
+    Get the columnar metadata of a chunk, built once and shared in the process
+    It is rebuilt when chunk.csv changes
+    """
+    csv_ad = osp.join(root, chunk_name + ".csv")
+    stat = os.stat(csv_ad)
+    stamp = [stat.st_mtime_ns, stat.st_size]
+    meta = _META.get(csv_ad)
+    if meta is not None and meta["stamp"] == stamp:
+        return meta
+
+    meta_ad = osp.join(root, chunk_name + "_meta")
+    info_ad = osp.join(meta_ad, "meta.json")
+    info = None
+    if osp.exists(info_ad):
+        with open(info_ad, 'r') as f:
+            info = json.load(f)
+    if info is None or info.get("version") != META_VERSION or info["stamp"] != stamp:
+        info = build_meta(root, chunk_name)
+    meta = {"stamp": stamp, "ad": meta_ad, "columns": info["columns"], "derived": info["derived"],
+            "arrays": {}, "df": None}
+    _META[csv_ad] = meta
+    return meta
+
+
+def read_meta_column(root, chunk_name, column):
+    """
+    Read one column of chunk.csv (or derived one like snr_db_value), as memory-mapped ndarray
+    """
+    meta = get_meta(root, chunk_name)
+    if column not in meta["arrays"]:
+        if column not in meta["columns"] + meta["derived"]:
+            raise KeyError("'{}' is not a column of {}.csv".format(column, chunk_name))
+        meta["arrays"][column] = np.load(osp.join(meta["ad"], column + ".npy"), mmap_mode='r')
+    return meta["arrays"][column]
+
+
+def read_meta(root, chunk_name):
+    """
+    Read chunk.csv as DataFrame, from the columnar metadata. Do not modify it in place, it is shared
+    """
+    meta = get_meta(root, chunk_name)
+    if meta["df"] is None:
+        meta["df"] = pd.DataFrame({column: read_meta_column(root, chunk_name, column)
+                                   for column in meta["columns"]})
+    return meta["df"]
+
+
+SNR_STYLES = {"mean": np.mean, "min": np.min, "max": np.max, "e": 0, "n": 1, "z": 2}
+
+
+def parse_snr_one(text):
+    """
+    Parse one snr_db string, [nan, nan, nan] if it is missing or has not 3 values
+    """
+    try:
+        values = np.array(text.replace('[', ' ').replace(']', ' ').split(), dtype=np.float32)
+    except ValueError:
+        values = None
+    if values is None or values.shape[0] != 3:
+        return np.full(3, np.nan, dtype=np.float32)
+    return values
+
+
+def parse_snr(snr):
+    """
+    Parse snr_db strings like "[56.79999924 55.40000153 47.40000153]" in one pass
+    Rows without 3 values, like missing snr_db of noise traces, are [nan, nan, nan]
+
+    :param snr: ndarray of str, N rows
+    :return: (N, 3) float32, channels are E, N, Z
+    """
+    snr = np.asarray(snr, dtype=str)
+    result = np.full((snr.shape[0], 3), np.nan, dtype=np.float32)
+    if snr.shape[0] == 0:
+        return result
+    # values of a row are separated by single spaces, counted for every row at once
+    text = np.char.replace(np.char.replace(snr, '[', ' '), ']', ' ')
+    while np.any(np.char.find(text, '  ') >= 0):
+        text = np.char.replace(text, '  ', ' ')
+    text = np.char.strip(text)
+    valid = (np.char.str_len(text) > 0) & (np.char.count(text, ' ') == 2)
+    try:
+        result[valid] = np.array(" ".join(text[valid].tolist()).split(), dtype=np.float32).reshape(-1, 3)
+    except ValueError:
+        # some value is not a number
+        result[valid] = np.stack([parse_snr_one(one) for one in text[valid].tolist()])
+    return result
+
+
+def reduce_snr(snr, style):
+    """
+    Reduce (N, 3) snr to (N, ), by "mean", "min", "max", or one channel "e", "n", "z"
+    """
+    if style not in SNR_STYLES:
+        raise TypeError("Unknown type of style")
+    reduce = SNR_STYLES[style]
+    if isinstance(reduce, int):
+        return np.asarray(snr[:, reduce])
+    return reduce(snr, axis=1)
+
+
+def read_snr(df, style):
+    return reduce_snr(parse_snr(df.snr_db.values), style)
 
 
-def get_dist(feature, bins, chunk_name, data_size, v_min=None, v_max=None):
-    df = pd.read_csv(osp.join(ROOT, chunk_name, chunk_name + ".csv"))
+def read_meta_snr(root, chunk_name, style):
+    """
+    Read snr_db of chunk, parsed once when building the metadata
+    """
+    return reduce_snr(read_meta_column(root, chunk_name, "snr_db_value"), style)
+
+
+def read_hist_index(root, chunk_name, feature, data_size, snr_style="mean"):
+    """
+    Get the sorted finite values of a feature, saved as root/<chunk_name>_meta/hist_*.npy
+    snr_db uses all rows (reduced by snr_style), the others use the first (data_size - 1) rows
+
+    :return: Sorted values (float64), memory-mapped
+    """
+    meta = get_meta(root, chunk_name)
     if feature == "snr_db":
-        data = read_snr(df, style="mean")
+        name = "hist_snr_db_{}".format(snr_style)
+    else:
+        num = read_meta_column(root, chunk_name, feature).shape[0]
+        name = "hist_{}_{}".format(feature, len(range(num)[:data_size - 1]))
+    if name not in meta["arrays"]:
+        hist_ad = osp.join(meta["ad"], name + ".npy")
+        if not osp.exists(hist_ad):
+            if feature == "snr_db":
+                data = read_meta_snr(root, chunk_name, snr_style)
+            else:
+                data = read_meta_column(root, chunk_name, feature)[:data_size - 1]
+            # "None" in source_depth_km is nan in metadata
+            data = np.asarray(data, dtype=np.float64)
+            save_replace(hist_ad, np.save, np.sort(data[~np.isnan(data)]))
+        meta["arrays"][name] = np.load(hist_ad, mmap_mode='r')
+    return meta["arrays"][name]
+
+
+def hist_from_sorted(values, bins, v_min=None, v_max=None):
+    """
+    Count values in equal-width bins like pd.cut, by binary search on sorted values
+
+    :param values: Sorted values
+    :param bins: Number of bins
+    :param v_min: If not None, values < v_min are removed and the range starts at v_min
+    :param v_max: If not None, values > v_max are removed and the range ends at v_max
+    :return: x (bin centers), y (counts)
+    """
+    lo = 0 if v_min is None else np.searchsorted(values, v_min, side='left')
+    hi = values.shape[0] if v_max is None else np.searchsorted(values, v_max, side='right')
+    if (lo >= hi) & ((v_min is None) | (v_max is None)):
+        raise ValueError("No values in the given range!")
+    mn = values[lo] if v_min is None else v_min
+    mx = values[hi - 1] if v_max is None else v_max
+
+    # the same edges as pd.cut, the first one is extended by 0.1% to include mn
+    if mn == mx:
+        mn = mn - 0.001 * abs(mn) if mn != 0 else mn - 0.001
+        mx = mx + 0.001 * abs(mx) if mx != 0 else mx + 0.001
+        edges = np.linspace(mn, mx, bins + 1)
+    else:
+        edges = np.linspace(mn, mx, bins + 1)
+        edges[0] = edges[0] - (mx - mn) * 0.001
+    y = np.diff(np.searchsorted(values[lo:hi], edges, side='right'))
+
+    # bin centers are given by edges rounded like the interval labels of pd.cut, whose precision starts at 3
+    # and is raised until the labels are unique
+    for precision in range(3, 20):
+        labels = np.array([round_frac(edge, precision) for edge in edges])
+        if np.unique(labels).shape[0] == edges.shape[0]:
+            break
     else:
-        data = df.loc[:, feature].values.reshape(-1)[:data_size - 1]
-
-    if feature == "source_depth_km":
-        data = data[data != "None"].astype(float)
-
-    if v_min is not None:
-        data = data[data >= v_min]
-        data = np.append(data, v_min)
-    if v_max is not None:
-        data = data[data <= v_max]
-        data = np.append(data, v_max)
-    label, _ = pd.cut(data, bins=bins, retbins=True)
-    label_vc = pd.DataFrame(label).value_counts()
-    interval, y = label_vc.index.tolist(), label_vc.values
-    x, left, right = [], float('inf'), -float('inf')
-    for i in range(bins):
-        interval_one = interval[i][0]
-        left_one, right_one = interval_one.left, interval_one.right
-        x.append((left_one + right_one) / 2)
-        if left_one < left:
-            left = left_one
-        if right_one > right:
-            right = right_one
-    x = np.array(x)
-    sort_index = np.argsort(x)
-    x, y = x[sort_index], y[sort_index]
-    if v_min is not None:
-        y[0] = y[0] - 1
-    if v_max is not None:
-        y[-1] = y[-1] - 1
+        labels = np.array([round_frac(edge, 3) for edge in edges])
+    x = (labels[:-1] + labels[1:]) / 2
     return x, y
 
 
+def round_frac(x, precision):
+    """
+    Round x to precision significant digits after the leading zeros of its fraction, like pd.cut labels
+    """
+    if not np.isfinite(x) or x == 0:
+        return x
+    frac, whole = np.modf(x)
+    if whole == 0:
+        digits = -int(np.floor(np.log10(abs(frac)))) - 1 + precision
+    else:
+        digits = precision
+    return np.around(x, digits)
+
+
+def get_dist(feature, bins, chunk_name, data_size, v_min=None, v_max=None, snr_style="mean"):
+    values = read_hist_index(osp.join(ROOT, chunk_name), chunk_name, feature, data_size, snr_style)
+    return hist_from_sorted(values, bins, v_min, v_max)
+
+
+def get_cell(la, lo):
+    """
+    Get the cell of grid (GRID_DEG x GRID_DEG degrees) where epicenters are located, cell = row * n_lo + col
+    """
+    n_la, n_lo = int(np.ceil(180 / GRID_DEG)), int(np.ceil(360 / GRID_DEG))
+    row = np.clip(np.floor((np.asarray(la) + 90) / GRID_DEG), 0, n_la - 1).astype(np.int64)
+    col = np.clip(np.floor((np.asarray(lo) + 180) / GRID_DEG), 0, n_lo - 1).astype(np.int64)
+    return row * n_lo + col
+
+
+def read_grid_index(root, chunk_name):
+    """
+    Get the spatial grid index of epicenters, saved as grid_order.npy and grid_start.npy in metadata
+    order: rows of chunk.csv sorted by cell, in a fixed random order inside each cell
+    start: order[start[c]: start[c + 1]] are the rows in cell c
+    """
+    meta = get_meta(root, chunk_name)
+    if "grid_order" not in meta["arrays"]:
+        order_ad, start_ad = osp.join(meta["ad"], "grid_order.npy"), osp.join(meta["ad"], "grid_start.npy")
+        if not (osp.exists(order_ad) & osp.exists(start_ad)):
+            la = read_meta_column(root, chunk_name, "source_latitude")
+            lo = read_meta_column(root, chunk_name, "source_longitude")
+            valid = np.argwhere(np.isfinite(la) & np.isfinite(lo)).reshape(-1)
+            cell = get_cell(la[valid], lo[valid])
+            shuffle = np.random.default_rng(100).permutation(valid.shape[0])
+            order = valid[np.lexsort((shuffle, cell))]
+            n_cell = int(np.ceil(180 / GRID_DEG)) * int(np.ceil(360 / GRID_DEG))
+            start = np.searchsorted(np.sort(cell), np.arange(n_cell + 1))
+            save_replace(order_ad, np.save, order.astype(np.int64))
+            save_replace(start_ad, np.save, start.astype(np.int64))
+        meta["arrays"]["grid_order"] = np.load(order_ad, mmap_mode='r')
+        meta["arrays"]["grid_start"] = np.load(start_ad, mmap_mode='r')
+    return meta["arrays"]["grid_order"], meta["arrays"]["grid_start"]
+
+
+def locate_source(root, chunk_name, la_min, la_max, lo_min, lo_max, num=LOCATE_NUM):
+    """
+    Find rows whose epicenters are in the box, only cells intersecting the box are read
+    If more than num rows are found, a deterministic sample is taken, stratified by cell
+
+    :return: Rows of chunk.csv, grouped by cell
+    """
+    if (la_min > la_max) | (lo_min > lo_max):
+        return np.array([], dtype=np.int64)
+    order, start = read_grid_index(root, chunk_name)
+    la = read_meta_column(root, chunk_name, "source_latitude")
+    lo = read_meta_column(root, chunk_name, "source_longitude")
+    n_lo = int(np.ceil(360 / GRID_DEG))
+    c_min, c_max = get_cell(la_min, lo_min), get_cell(la_max, lo_max)
+    col_min, col_max = c_min % n_lo, c_max % n_lo
+
+    # cells in one row of grid are contiguous in order
+    idx = np.concatenate([order[start[row * n_lo + col_min]: start[row * n_lo + col_max + 1]]
+                          for row in range(c_min // n_lo, c_max // n_lo + 1)])
+    la_idx, lo_idx = la[idx], lo[idx]
+    idx = idx[(la_idx >= la_min) & (la_idx <= la_max) & (lo_idx >= lo_min) & (lo_idx <= lo_max)]
+    if idx.shape[0] <= num:
+        return idx
+
+    # each cell keeps a share proportional to its count (largest remainder), from its random order
+    _, first, inverse, count = np.unique(get_cell(la[idx], lo[idx]), return_index=True,
+                                         return_inverse=True, return_counts=True)
+    share = count * num / idx.shape[0]
+    quota = np.floor(share).astype(np.int64)
+    remain = num - quota.sum()
+    quota[np.argsort(quota - share, kind='stable')[:remain]] += 1
+    rank = np.arange(idx.shape[0]) - first[inverse]
+    return idx[rank < quota[inverse]]
+
+
+def get_tile_key(la, lo, zoom):
+    """
+    Get the cell of epicenters at given zoom, the map (equirectangular, north up) has
+    (2 ** zoom * TILE_CELLS) x (2 ** zoom * TILE_CELLS) cells, key = row * size + col
+    """
+    size = 2 ** zoom * TILE_CELLS
+    row = np.clip(np.floor((90 - np.asarray(la)) / 180 * size), 0, size - 1).astype(np.int64)
+    col = np.clip(np.floor((np.asarray(lo) + 180) / 360 * size), 0, size - 1).astype(np.int64)
+    return row * size + col
+
+
+def build_tile(root, chunk_name):
+    """
+    Build the pyramid of epicenter aggregates from zoom TILE_ZOOM to 0, saved as tile_<zoom>.npz in metadata
+    Each level keeps the non-empty cells (sorted key) with count, sum and max of magnitude
+    """
+    meta = get_meta(root, chunk_name)
+    la = read_meta_column(root, chunk_name, "source_latitude")
+    lo = read_meta_column(root, chunk_name, "source_longitude")
+    sm = read_meta_column(root, chunk_name, "source_magnitude")
+    valid = np.isfinite(la) & np.isfinite(lo) & np.isfinite(sm)
+    key = get_tile_key(la[valid], lo[valid], TILE_ZOOM)
+    count, total, peak = np.ones(key.shape[0], dtype=np.int64), sm[valid], sm[valid]
+    for zoom in range(TILE_ZOOM, -1, -1):
+        if zoom < TILE_ZOOM:    # merge 2 x 2 cells of the finer level
+            size = 2 ** (zoom + 1) * TILE_CELLS
+            key = (key // size // 2) * (size // 2) + (key % size) // 2
+        order = np.argsort(key, kind='stable')
+        key, count, total, peak = key[order], count[order], total[order], peak[order]
+        key, first = np.unique(key, return_index=True)
+        count, total, peak = np.add.reduceat(count, first), np.add.reduceat(total, first), \
+            np.maximum.reduceat(peak, first)
+        save_replace(osp.join(meta["ad"], "tile_{}.npz".format(zoom)), np.savez, key=key, count=count, total=total,
+                     peak=peak)
+    return None
+
+
+def read_tile(root, chunk_name, zoom, x, y, num=LOCATE_NUM):
+    """
+    Get the epicenter aggregates in tile (zoom, x, y), x from west to east and y from north to south
+    Zoom above TILE_ZOOM gives raw epicenters (count 1) in the tile, at most num
+
+    :return: lo, la (cell centers), count, mean and max magnitude, of non-empty cells
+    """
+    if zoom > TILE_ZOOM:
+        width, height = 360 / 2 ** zoom, 180 / 2 ** zoom
+        la_max, lo_min = 90 - y * height, -180 + x * width
+        idx = locate_source(root, chunk_name, la_max - height, la_max, lo_min, lo_min + width, num)
+        sm = read_meta_column(root, chunk_name, "source_magnitude")[idx]
+        return read_meta_column(root, chunk_name, "source_longitude")[idx], \
+            read_meta_column(root, chunk_name, "source_latitude")[idx], np.ones(idx.shape[0], dtype=np.int64), sm, sm
+
+    meta = get_meta(root, chunk_name)
+    name = "tile_{}".format(zoom)
+    if name not in meta["arrays"]:
+        tile_ad = osp.join(meta["ad"], name + ".npz")
+        if not osp.exists(tile_ad):
+            build_tile(root, chunk_name)
+        with np.load(tile_ad) as f:
+            meta["arrays"][name] = {k: f[k] for k in f.files}
+    level = meta["arrays"][name]
+
+    # cells of one row in tile are contiguous in key
+    size = 2 ** zoom * TILE_CELLS
+    key_start = np.arange(y * TILE_CELLS, (y + 1) * TILE_CELLS) * size + x * TILE_CELLS
+    left = np.searchsorted(level["key"], key_start, side='left')
+    right = np.searchsorted(level["key"], key_start + TILE_CELLS, side='left')
+    idx = np.concatenate([np.arange(a, b) for a, b in zip(left, right)]).astype(np.int64)
+    row, col = level["key"][idx] // size, level["key"][idx] % size
+    count = level["count"][idx]
+    return (col + 0.5) * 360 / size - 180, 90 - (row + 0.5) * 180 / size, count, \
+        level["total"][idx] / count, level["peak"][idx]
+
+
 def be_numpy(x):
     if torch.is_tensor(x):
         return x.numpy()
@@ -297,7 +1107,7 @@ class Chunk(Dataset):
         super(Chunk, self).__init__()
         self.data_size, self.root, self.name = data_size, root, chunk_name
         self.save_ad = osp.join(root, str(data_size))
-        self.df = pd.read_csv(osp.join(self.root, self.name + ".csv"))
+        self.df = read_meta(self.root, self.name)
         self.data, self.index = self.get_sample()
         self.df = self.df.iloc[self.index, :]
         self.data_size_train = data_size_train
@@ -307,7 +1117,7 @@ class Chunk(Dataset):
         self.get_train_or_test()
 
     def get_train_or_test(self):
-        self.data = self.data[self.idx, :, :]
+        self.data = torch.from_numpy(np.asarray(self.data[self.idx, :, :]))
         self.index = self.index[self.idx]
         self.df = self.df.iloc[self.idx, :]
         return None
@@ -320,34 +1130,9 @@ class Chunk(Dataset):
         return data, index
 
     def get_sample(self):
-        if not osp.exists(self.save_ad):
-            os.makedirs(self.save_ad)
-        data_ad = osp.join(self.save_ad, "data.pt")
-        index_ad = osp.join(self.save_ad, "index.pt")
-        if osp.exists(data_ad) & osp.exists(index_ad):
-            data = torch.load(data_ad)
-            index = be_numpy(torch.load(index_ad))
-        else:
-            metadata = h5py.File(osp.join(self.root, self.name + ".hdf5"), 'r')
-
-            trace_name = self.df.loc[:, "trace_name"].values.reshape(-1)
-            index = np.random.choice(trace_name.shape[0], self.data_size, replace=False).tolist()
-
-            ev_list = self.df['trace_name'].to_list()
-            data = np.zeros(shape=(self.data_size, 3, 6000))
-            for c, i in enumerate(index):
-                ev_one = ev_list[i]
-                dataset_one = metadata.get('data/' + str(ev_one))
-                data_one = np.array(dataset_one)
-                data_one = np.expand_dims(data_one.T, axis=0)
-                data[c, :, :] = data_one
-
-            data = torch.from_numpy(data).float()
-            index = torch.FloatTensor(index).int()
-
-            torch.save(data, data_ad)
-            torch.save(index, index_ad)
-        return data, be_numpy(index)
+        if not is_legacy_sample(self.root, self.data_size):
+            grow_store(self.root, self.name, self.data_size)
+        return load_sample(self.root, self.data_size)
 
 
 def get_mai_data(df_train, df_test):
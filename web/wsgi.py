@@ -29,7 +29,7 @@ registry user and model, for operation estimation
 """
 registry = DlRegistry()
 
-registry.add_model(model_object=network.MagInfoNet(),
+registry.add_model(model_object=network.MagInfoNet,
                    name="MagInfoNet",
                    description="Proposed model",
                    owner="Chen Ziwei",
@@ -41,7 +41,7 @@ registry.add_model(model_object=network.MagInfoNet(),
                    code_test=get_source(MagInfoNet.code_test),
                    code_run=get_source(MagInfoNet.code_run),)
 
-registry.add_model(model_object=network.EQGraphNet(),
+registry.add_model(model_object=network.EQGraphNet,
                    name="EQGraphNet",
                    description="Proposed model",
                    owner="Chen Ziwei",
@@ -53,7 +53,7 @@ registry.add_model(model_object=network.EQGraphNet(),
                    code_test=get_source(EQGraphNet.code_test),
                    code_run=get_source(EQGraphNet.code_run),)
 
-registry.add_model(model_object=network.MagNet(),
+registry.add_model(model_object=network.MagNet,
                    name="MagNet",
                    description="From 10.1029/2019GL085976",
                    owner="Mousavi",
@@ -65,7 +65,7 @@ registry.add_model(model_object=network.MagNet(),
                    code_test=get_source(MagNet.code_test),
                    code_run=get_source(MagNet.code_run),)
 
-registry.add_model(model_object=network.CREIME(),
+registry.add_model(model_object=network.CREIME,
                    name="CREIME",
                    description="From 10.1029/2022JB024595",
                    owner="Chakraborty",
@@ -77,7 +77,7 @@ registry.add_model(model_object=network.CREIME(),
                    code_test=get_source(CREIME.code_test),
                    code_run=get_source(CREIME.code_run),)
 
-registry.add_model(model_object=network.ConvNetQuakeINGV(),
+registry.add_model(model_object=network.ConvNetQuakeINGV,
                    name="ConvNetQuakeINGV",
                    description="From 90/2A/517/568771",
                    owner="Lomax",
@@ -130,4 +130,9 @@ registry.add_feature(param="source_longitude",
 
 registry.init_info()
 
+"""
+start dispatching train/test jobs to worker processes
+"""
+registry.scheduler.start()
+
 print()